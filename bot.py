@@ -1,18 +1,47 @@
 
+import contextvars
+import functools
+import glob
+import hashlib
+import heapq
+import io
+import itertools
 import logging
+import multiprocessing
 import json
-from datetime import datetime
+import re
+import secrets
+import signal
+import sqlite3
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
+from collections import OrderedDict, deque
 import os
+import random
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 import colorlog
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackContext
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, TypeHandler,
+                          filters, CallbackContext)
 import asyncio
 import nest_asyncio
 from google.generativeai import configure, GenerativeModel, upload_file
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from google.generativeai.types import GenerationConfig as GenConfig
+try:
+    from google.generativeai import caching
+except ImportError:  # старые версии SDK без кеширования контекста
+    caching = None
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+from google.api_core.client_options import ClientOptions
 import httpx
 from typing import Optional, Dict, Any
 
@@ -27,6 +56,143 @@ TELEGRAM_TOKEN = ""
 GEMINI_API_KEY = ""
 YOUR_CHAT_ID = ""
 
+# Получение обновлений: "polling" или "webhook" (можно переопределить при запуске: python bot.py webhook)
+UPDATE_MODE = "polling"
+# Встроенный HTTP-сервер для вебхука; WEBHOOK_URL — публичный адрес (за прокси — адрес прокси),
+# без него режим вебхука не запускается
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_URL = ""
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token, запросы без него отклоняются.
+# Пустой — выводится из TELEGRAM_TOKEN: одинаков у всех экземпляров и у python bot.py fake-update
+WEBHOOK_SECRET_TOKEN = ""
+# Только те типы обновлений, для которых есть обработчики: команды, текст, фото и новые участники
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Число процессов-обработчиков. Больше 1 — основной процесс только принимает обновления и
+# раздаёт их по хешу chat_id; каждый обработчик владеет историей и настройками своих чатов
+SHARD_WORKERS = 1
+
+# Обновления разных чатов обрабатываются параллельно, одного чата — строго по порядку
+UPDATE_MAX_CONCURRENCY = 64
+# Сколько обновлений может ждать своей очереди в одном чате
+UPDATE_QUEUE_PER_CHAT = 20
+# При переполнении: "drop_oldest" — отбросить самое старое ожидающее обновление,
+# "merge" — старое текстовое сообщение только записать в историю (без ответа), оно станет контекстом
+UPDATE_QUEUE_OVERFLOW = "merge"
+
+# Дополнительные ключи Gemini: строки или словари {'api_key': ..., 'model': ..., 'rpm': ..., 'tpm': ...}.
+# Если список пуст, используется только GEMINI_API_KEY
+GEMINI_API_KEYS: List[Any] = []
+GEMINI_MODEL_NAME = "gemini-1.5-flash-002"
+# На сколько секунд выводить из ротации ключ, отклонённый как недействительный
+GEMINI_AUTH_QUARANTINE = 600.0
+
+# Сколько запросов к Gemini может выполняться одновременно; остальные ждут в очереди
+GEMINI_MAX_CONCURRENCY = 8
+# Размер собственного пула потоков, если в SDK нет асинхронного API
+GEMINI_EXECUTOR_WORKERS = 8
+
+# Квота ключа Gemini (запросы и токены в минуту) — выставить под свой тариф
+GEMINI_RPM = 15
+GEMINI_TPM = 1_000_000
+# Сколько токенов ответа закладывать при оценке запроса (уточняется по usage_metadata)
+GEMINI_OUTPUT_TOKEN_ESTIMATE = 300
+
+# Предохранитель: если за последние CIRCUIT_WINDOW секунд не меньше половины запросов
+# (и хотя бы CIRCUIT_MIN_CALLS) упали или шли дольше CIRCUIT_SLOW_CALL, запросы к Gemini
+# не отправляются CIRCUIT_OPEN_FOR секунд, после чего пробуем один пробный запрос
+CIRCUIT_FAILURE_RATIO = 0.5
+CIRCUIT_MIN_CALLS = 5
+CIRCUIT_WINDOW = 60.0
+CIRCUIT_SLOW_CALL = 25.0
+CIRCUIT_OPEN_FOR = 30.0
+
+# Приоритеты запросов к модели: меньше — раньше
+PRIORITY_HIGH = 0    # личные чаты и ответы на сообщения бота
+PRIORITY_NORMAL = 1  # обращения по триггеру в группах
+PRIORITY_LOW = 2     # фоновые запросы (пересказ истории)
+
+# Сколько токенов истории (пересказ + последние сообщения) допускается в промпте
+CONTEXT_TOKEN_BUDGET = 3000
+# Пересказ старой переписки обновляется, когда из окна выпало столько новых сообщений
+SUMMARY_REFRESH_MESSAGES = 20
+
+# Потоковые ответы: сообщение отправляется с первым чанком и затем дополняется правками
+STREAM_REPLIES = True
+# Минимальный интервал между правками одного сообщения (ограничения Telegram на edit_message_text)
+STREAM_EDIT_INTERVAL = 1.5
+
+# Изображения до этого размера передаются в запросе встроенными байтами, крупнее — через File API
+# (у Gemini ограничение на весь запрос — 20 МБ)
+INLINE_IMAGE_LIMIT = 15 * 1024 * 1024
+
+# Кеш загруженных в Gemini изображений: повторные картинки не скачиваются и не загружаются заново.
+# Картинки крупнее INLINE_IMAGE_LIMIT кешируются ссылкой на файл File API, мелкие — своими байтами
+# в памяти (их дешевле передать встроенными в запрос), не больше IMAGE_CACHE_INLINE_BYTES на всё
+IMAGE_CACHE_ENABLED = True
+IMAGE_CACHE_PATH = "image_cache.json"
+IMAGE_CACHE_MAX_ENTRIES = 5000
+IMAGE_CACHE_INLINE_BYTES = 64 * 1024 * 1024
+# Файлы File API живут 48 часов; берём с запасом
+IMAGE_CACHE_TTL = 47 * 3600
+
+# Одинаковые одновременные запросы к модели объединяются в один; точные повторы
+# отдаются из кеша в течение RESPONSE_CACHE_TTL секунд (0 — кеш выключен)
+RESPONSE_CACHE_TTL = 30.0
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+# Сколько экземпляров GenerativeModel (ключ × системные инструкции × конфиг) держать в памяти
+MODEL_CACHE_MAX_ENTRIES = 64
+
+# Кеширование системных инструкций на стороне Gemini (CachedContent): большой общий префикс
+# не пересылается с каждым запросом. Сервер кеширует только достаточно длинный контекст,
+# короче CONTEXT_CACHE_MIN_TOKENS инструкции уходят как обычно.
+CONTEXT_CACHE_ENABLED = True
+CONTEXT_CACHE_BACKEND = "gemini"  # "fake" — локальная замена без сети для проверки
+CONTEXT_CACHE_TTL = 3600
+CONTEXT_CACHE_MIN_TOKENS = 32768
+# После ошибки создания кеша не пытаться снова столько секунд
+CONTEXT_CACHE_RETRY_AFTER = 600.0
+
+# Стиль по умолчанию; /style меняет его для чата. Стиль входит в системные инструкции, а не в промпт
+DEFAULT_STYLE_PROMPT = """Отвечай блять, как двачер(не более 1000 символов)..."""
+DEFAULT_IMAGE_STYLE_PROMPT = ("Отвечай блять, как двачер. Если описываешь изображение, то уложись в 600 "
+                              "символов (ЕСЛИ НУЖНО, то в ответе запрещёнку завуалируй смайликами):")
+
+# Хранилище истории чатов: "json" — файлы chat_history/chat_<id>.json, "sqlite" — база в режиме WAL.
+# Перенос существующих файлов в базу: python bot.py migrate-history
+HISTORY_BACKEND = "json"
+HISTORY_DB_PATH = "chat_history.db"
+# Сколько сообщений на чат хранится в базе (в памяти и в промпте — меньше)
+HISTORY_DB_MAX_MESSAGES = 1000
+
+# HTTP-эндпоинт /metrics в формате Prometheus (у шардов порт METRICS_PORT + 1 + номер шарда)
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# Выборочная трассировка обновлений (этапы от приёма до отправки ответа) в файл JSON Lines:
+# доля трассируемых обновлений, 0 — выключено, 1 — каждое
+TRACE_SAMPLE_RATE = 0.0
+TRACE_PATH = "traces.jsonl"
+TRACE_FLUSH_INTERVAL = 1.0
+
+# Профилировщик запускается командой /profile [секунды] из YOUR_CHAT_ID или сигналом SIGUSR1;
+# профиль в свёрнутом формате (flamegraph.pl, speedscope) пишется в PROFILE_DIR
+PROFILE_DIR = "profiles"
+PROFILE_DEFAULT_SECONDS = 30.0
+PROFILE_MAX_SECONDS = 300.0
+PROFILE_INTERVAL = 0.005
+
+# Настройки чатов (триггеры, стиль, инструкции): снимок + журнал изменений
+SETTINGS_PATH = "chat_settings.json"
+SETTINGS_FLUSH_INTERVAL = 1.0
+
+# Сколько секунд ждать продолжения после обращения к боту, прежде чем отвечать на всю пачку сообщений
+DEBOUNCE_WINDOW = 1.0
+
 
 def create_color_formatter():
     return colorlog.ColoredFormatter(
@@ -48,13 +214,428 @@ class NameFilter(logging.Filter):
         return True
 
 
-class ChatHistoryManager:
-    def __init__(self, storage_dir: str = "chat_history"):
+class Metrics:
+    """
+    Счётчики и гистограммы задержек в текстовом формате Prometheus (без внешних зависимостей).
+
+    Гистограмма ``bot_stage_seconds`` с меткой stage покрывает этапы обработки: get_me,
+    history_load, history_flush, prompt_build, gemini_wait, gemini_first_token, gemini_total,
+    telegram_send, telegram_edit, image_download, reply. Значения-датчики (глубина очередей
+    и т.п.) вычисляются функциями в момент отдачи /metrics.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    DESCRIPTIONS = {
+        'bot_stage_seconds': "Latency of a processing stage",
+        'bot_updates_total': "Updates handled, by kind",
+        'bot_errors_total': "Errors, by place",
+        'bot_gemini_requests_total': "Gemini calls, by outcome",
+        'bot_gemini_retries_total': "Gemini call retries, by request kind",
+        'bot_gemini_blocked_total': "Gemini responses blocked by safety filters",
+        'bot_gemini_tokens_total': "Tokens reported in usage_metadata, by kind",
+        'bot_markdown_replies_total': "Replies sent with MarkdownV2, by outcome (formatted or plain fallback)",
+    }
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters: Dict[tuple, float] = {}
+        # (имя, метки) -> [счётчики по корзинам..., сумма, количество]
+        self._histograms: Dict[tuple, List[float]] = {}
+        self._gauges: Dict[str, Any] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def stage(self, stage: str, seconds: float):
+        self.observe('bot_stage_seconds', seconds, stage=stage)
+        # Тот же этап — в трассу обновления, если оно попало в выборку
+        tracer.record(stage, seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Замер этапа: with metrics.timer('history_load'): ..."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage(stage, time.monotonic() - started)
+
+    def gauge(self, name: str, func, description: str = '', label: str = 'key'):
+        """Датчик: func() возвращает число или словарь {значение метки label: число}"""
+        self._gauges[name] = (func, description, label)
+
+    @staticmethod
+    def _format_labels(labels, extra: str = '') -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def header(name: str, kind: str, description: str = ''):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# HELP {name} {description or self.DESCRIPTIONS.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, histogram):
+                le = f'le="{bound:g}"'
+                lines.append(f"{name}_bucket{self._format_labels(labels, le)} {count}")
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{self._format_labels(labels, le)} {histogram[-1]}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-2]:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-1]}")
+
+        for name, (func, description, label_name) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logging.error(f"Ошибка вычисления метрики {name}: {e}")
+                continue
+            header(name, 'gauge', description)
+            if isinstance(value, dict):
+                for label, item in sorted(value.items()):
+                    lines.append(f'{name}{{{label_name}="{label}"}} {item:g}')
+            else:
+                lines.append(f"{name} {value:g}")
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Минимальный HTTP-сервер: GET /metrics отдаёт метрики в формате Prometheus"""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5.0)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5.0)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', metrics.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.getLogger('metrics').info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+class Trace:
+    """Трасса одного обновления: этапы с началом относительно приёма обновления и длительностью"""
+
+    def __init__(self, kind: str, chat_id: Optional[str] = None, update_id: Optional[int] = None):
+        self.trace_id = secrets.token_hex(8)
+        self.kind = kind
+        self.chat_id = chat_id
+        self.update_id = update_id
+        self.started = time.monotonic()
+        self.started_at = datetime.now()
+        self.spans: List[Dict[str, Any]] = []
+        self.attrs: Dict[str, Any] = {}
+        # Обработчик передал трассу дальше (в пачку ответа) — завершит её тот, кто ответит
+        self.detached = False
+        self.finished = False
+        self.duration = None
+
+    def record(self, name: str, seconds: float, **attrs):
+        if self.finished:
+            return
+        end = time.monotonic()
+        span = {
+            'name': name,
+            'start_ms': round((end - seconds - self.started) * 1000, 3),
+            'duration_ms': round(seconds * 1000, 3),
+        }
+        if attrs:
+            span['attrs'] = attrs
+        self.spans.append(span)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'chat_id': self.chat_id,
+            'update_id': self.update_id,
+            'timestamp': self.started_at.isoformat(),
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'attrs': self.attrs,
+            'spans': self.spans,
+        }
+
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar('current_trace', default=None)
+
+
+class Tracer:
+    """
+    Выборочная трассировка обновлений в файл JSON Lines (одна завершённая трасса — одна строка).
+
+    Трассируется доля sample_rate обновлений. Текущая трасса передаётся через contextvars,
+    поэтому этапы, замеренные metrics.stage/metrics.timer, попадают в неё без явной передачи.
+    Запись на диск отложенная, пачками в фоновом потоке.
+    """
+
+    def __init__(self, path: str = TRACE_PATH, sample_rate: float = TRACE_SAMPLE_RATE,
+                 flush_interval: float = TRACE_FLUSH_INTERVAL):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self._pending: List[str] = []
+        self._flush_handle = None
+        self.stats = {'sampled': 0, 'exported': 0}
+
+    def start(self, kind: str, chat_id: Optional[str] = None, update_id: Optional[int] = None) -> Optional[Trace]:
+        """Новая трасса или None, если обновление не попало в выборку"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        self.stats['sampled'] += 1
+        return Trace(kind, chat_id, update_id)
+
+    @contextmanager
+    def activate(self, trace: Optional[Trace]):
+        """Делает trace текущей на время блока (None — ни одна трасса не текущая)"""
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+
+    def record(self, name: str, seconds: float, **attrs):
+        trace = current_trace.get()
+        if trace is not None:
+            trace.record(name, seconds, **attrs)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Этап только для трассы (без гистограммы): with tracer.span('trigger_match'): ..."""
+        if current_trace.get() is None:
+            yield
+            return
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started, **attrs)
+
+    def annotate(self, **attrs):
+        trace = current_trace.get()
+        if trace is not None:
+            trace.attrs.update(attrs)
+
+    def finish(self, trace: Optional[Trace], **attrs):
+        if trace is None or trace.finished:
+            return
+        trace.attrs.update(attrs)
+        trace.duration = time.monotonic() - trace.started
+        trace.finished = True
+        self._pending.append(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._take())
+            return
+
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: loop.create_task(self.flush())
+            )
+
+    def _take(self) -> List[str]:
+        pending, self._pending = self._pending, []
+        return pending
+
+    def _write(self, lines: List[str]):
+        if not lines:
+            return
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            self.stats['exported'] += len(lines)
+        except OSError as e:
+            logging.error(f"Ошибка при записи трасс: {e}")
+
+    async def flush(self):
+        self._flush_handle = None
+        lines = self._take()
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        await self.flush()
+
+
+tracer = Tracer()
+
+
+def traced(kind: str):
+    """
+    Трассировка обработчика обновления: трасса текущая на время обработчика и завершается
+    после него, если обработчик не передал её дальше (trace.detached).
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: CallbackContext):
+            chat = update.effective_chat
+            trace = tracer.start(kind, str(chat.id) if chat else None, update.update_id)
+            if trace is None:
+                return await handler(update, context)
+            try:
+                with tracer.activate(trace):
+                    return await handler(update, context)
+            finally:
+                if not trace.detached:
+                    tracer.finish(trace)
+
+        return wrapper
+
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    Выборочный профилировщик без зависимостей: фоновый поток каждые interval секунд снимает
+    стек потока цикла событий (sys._current_frames) и по окончании записывает стеки
+    в свёрнутом формате (``caller;callee count``) для flamegraph.pl, speedscope или inferno.
+    """
+
+    def __init__(self, output_dir: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.last_path: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float, thread_id: Optional[int] = None) -> Optional[str]:
+        """
+        Запускает профилирование потока thread_id (по умолчанию — вызывающего) на seconds секунд.
+        Возвращает путь будущего профиля или None, если профилировщик уже работает.
+        """
+        if self.running:
+            return None
+        thread_id = thread_id or threading.get_ident()
+        path = os.path.join(self.output_dir, f"profile_{os.getpid()}_{datetime.now():%Y%m%d_%H%M%S}.folded")
+        self._thread = threading.Thread(
+            target=self._run, args=(thread_id, seconds, path), name='sampling-profiler', daemon=True
+        )
+        self._thread.start()
+        logging.getLogger('profiler').info(f"Профилирование на {seconds:g} с, результат: {path}")
+        return path
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self, thread_id: int, seconds: float, path: str):
+        counts: Dict[str, int] = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+            time.sleep(self.interval)
+
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write(f"{stack} {count}\n")
+            self.last_path = path
+            logging.getLogger('profiler').info(f"Профиль записан: {path} ({sum(counts.values())} выборок)")
+        except OSError as e:
+            logging.error(f"Ошибка при записи профиля: {e}")
+
+
+profiler = SamplingProfiler()
+
+
+def install_profiler_signal():
+    """kill -USR1 <pid> запускает профилировщик на PROFILE_DEFAULT_SECONDS без перезапуска бота"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    try:
+        # Обработчик выполняется в потоке цикла событий — его и профилируем
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, lambda: profiler.start(PROFILE_DEFAULT_SECONDS)
+        )
+    except (NotImplementedError, RuntimeError) as e:
+        logging.getLogger('profiler').warning(f"Сигнал профилировщика не установлен: {e}")
+
+
+class JsonHistoryBackend:
+    """
+    История чатов в двух файлах на чат:
+
+    * ``chat_<id>.json`` — компактный снимок последних ``max_messages`` сообщений;
+    * ``chat_<id>.journal`` — журнал, в который только дописываются записи (одна строка JSON на запись).
+
+    Когда журнал разрастается до ``compact_threshold`` записей, он сворачивается в снимок
+    через атомарный rename. Методы блокирующие; write() вызывается из фонового потока.
+    """
+
+    def __init__(self, storage_dir: str = "chat_history", max_messages: int = 50,
+                 compact_threshold: Optional[int] = None):
         self.storage_dir = storage_dir
+        self.max_messages = max_messages
+        self.compact_threshold = compact_threshold or max_messages
+        self._seq: Dict[str, int] = {}
+        self._journal_sizes: Dict[str, int] = {}
         self._ensure_storage_exists()
-        self.chat_histories: Dict[str, List[Dict]] = {}
-        self.max_messages_per_chat = 50
-        self.load_all_histories()
 
     def _ensure_storage_exists(self):
         if not os.path.exists(self.storage_dir):
@@ -63,34 +644,388 @@ class ChatHistoryManager:
     def _get_chat_file_path(self, chat_id: str) -> str:
         return os.path.join(self.storage_dir, f"chat_{chat_id}.json")
 
-    def load_all_histories(self):
-        if not os.path.exists(self.storage_dir):
-            return
+    def _get_journal_file_path(self, chat_id: str) -> str:
+        return os.path.join(self.storage_dir, f"chat_{chat_id}.journal")
 
+    def chat_ids(self) -> List[str]:
+        chat_ids = set()
         for filename in os.listdir(self.storage_dir):
             if filename.startswith("chat_") and filename.endswith(".json"):
-                chat_id = filename[5:-5]
-                self.load_chat_history(chat_id)
+                chat_ids.add(filename[5:-5])
+            elif filename.startswith("chat_") and filename.endswith(".journal"):
+                chat_ids.add(filename[5:-8])
+        return sorted(chat_ids)
+
+    def load(self, chat_id: str) -> List[Dict]:
+        """Загрузка истории чата: снимок + воспроизведение журнала"""
+        messages: List[Dict] = []
+        seq = 0
 
-    def load_chat_history(self, chat_id: str):
-        """Загрузка истории конкретного чата"""
         file_path = self._get_chat_file_path(chat_id)
         if os.path.exists(file_path):
             try:
                 with open(file_path, 'r', encoding='utf-8') as f:
-                    self.chat_histories[chat_id] = json.load(f)
-            except json.JSONDecodeError:
-                self.chat_histories[chat_id] = []
+                    snapshot = json.load(f)
+                # Старый формат — просто список сообщений
+                if isinstance(snapshot, list):
+                    messages = snapshot
+                else:
+                    messages = snapshot.get('messages', [])
+                    seq = snapshot.get('seq', 0)
+            except (json.JSONDecodeError, AttributeError):
+                messages = []
+
+        journal_size = 0
+        journal_path = self._get_journal_file_path(chat_id)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная строка после аварийного завершения
+                        continue
+                    journal_size += 1
+                    # Запись уже вошла в снимок (сбой между сворачиванием и очисткой журнала)
+                    if record.get('seq', 0) <= seq:
+                        continue
+                    seq = record['seq']
+                    if record.get('op') == 'clear':
+                        messages = []
+                    elif record.get('op') == 'add':
+                        messages.append(record['message'])
+
+        self._seq[chat_id] = seq
+        self._journal_sizes[chat_id] = journal_size
+        return messages[-self.max_messages:]
+
+    def write(self, pending: Dict[str, List[Dict]]):
+        """Дописывание записей в журналы; разросшиеся журналы и очистки сворачиваются в снимок"""
+        for chat_id, records in pending.items():
+            if chat_id not in self._seq:
+                self.load(chat_id)
+            for record in records:
+                self._seq[chat_id] += 1
+                record['seq'] = self._seq[chat_id]
+
+            with open(self._get_journal_file_path(chat_id), 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records))
+            self._journal_sizes[chat_id] = self._journal_sizes.get(chat_id, 0) + len(records)
+
+            # Пустой снимок дешевле, чем журнал с записью об очистке
+            if self._journal_sizes[chat_id] >= self.compact_threshold or \
+                    any(r['op'] == 'clear' for r in records):
+                self.compact(chat_id)
+
+    def compact(self, chat_id: str):
+        """Сворачивание журнала чата в снимок"""
+        messages = self.load(chat_id)
+        self._write_snapshot(chat_id, messages, self._seq[chat_id])
+        self._journal_sizes[chat_id] = 0
+
+    def _write_snapshot(self, chat_id: str, messages: List[Dict], seq: int):
+        file_path = self._get_chat_file_path(chat_id)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'seq': seq, 'messages': messages[-self.max_messages:]}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+
+        # Журнал больше не нужен: всё, что в нём было, вошло в снимок
+        journal_path = self._get_journal_file_path(chat_id)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+    def forget(self, chat_id: str):
+        """Чат вытеснен из памяти менеджера — счётчики перечитаются при следующей загрузке"""
+        self._seq.pop(chat_id, None)
+        self._journal_sizes.pop(chat_id, None)
+
+    def close(self):
+        pass
+
+
+class SqliteHistoryBackend:
+    """
+    История чатов в одной базе SQLite в режиме WAL.
+
+    Сообщения лежат в таблице с индексом (chat_id, timestamp): загрузка чата — один
+    индексированный запрос, пачка записей — одна транзакция. Соединения переиспользуются:
+    запись идёт через одно соединение из фонового потока, чтение — через другое, и
+    благодаря WAL чтение не ждёт записи. В базе хранится до ``max_stored_messages``
+    сообщений на чат (больше, чем держится в памяти), их можно выбирать запросами по всем чатам.
+    """
+
+    def __init__(self, path: str = HISTORY_DB_PATH, max_messages: int = 50,
+                 max_stored_messages: int = HISTORY_DB_MAX_MESSAGES):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_stored_messages = max_stored_messages
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                username TEXT,
+                is_bot INTEGER NOT NULL DEFAULT 0,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp ON messages (chat_id, timestamp);
+        """)
+        self._reader = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def chat_ids(self) -> List[str]:
+        with self._read_lock:
+            return [row[0] for row in self._reader.execute("SELECT DISTINCT chat_id FROM messages")]
+
+    def load(self, chat_id: str, limit: Optional[int] = None) -> List[Dict]:
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT text, timestamp, username, is_bot FROM messages WHERE chat_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (chat_id, limit or self.max_messages)
+            ).fetchall()
+        return [
+            {'text': text, 'timestamp': timestamp, 'username': username, 'is_bot': bool(is_bot)}
+            for text, timestamp, username, is_bot in reversed(rows)
+        ]
+
+    def write(self, pending: Dict[str, List[Dict]]):
+        """Все записи пачки — одной транзакцией"""
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for chat_id, records in pending.items():
+                    rows = []
+                    for record in records:
+                        if record['op'] == 'clear':
+                            self._insert(cursor, chat_id, rows)
+                            rows = []
+                            cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                        elif record['op'] == 'add':
+                            message = record['message']
+                            rows.append((chat_id, message['timestamp'], message.get('username'),
+                                         int(bool(message.get('is_bot'))), message['text']))
+                    self._insert(cursor, chat_id, rows)
+                    self._trim(cursor, chat_id)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _insert(cursor: sqlite3.Cursor, chat_id: str, rows: List[tuple]):
+        if rows:
+            cursor.executemany(
+                "INSERT INTO messages (chat_id, timestamp, username, is_bot, text) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def _trim(self, cursor: sqlite3.Cursor, chat_id: str):
+        cursor.execute(
+            "DELETE FROM messages WHERE chat_id = ? AND id NOT IN ("
+            "SELECT id FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?)",
+            (chat_id, chat_id, self.max_stored_messages)
+        )
+
+    def compact(self, chat_id: str):
+        with self._write_lock:
+            self._trim(self._writer.cursor(), chat_id)
+
+    def forget(self, chat_id: str):
+        pass
+
+    def close(self):
+        with self._write_lock:
+            self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._writer.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+def create_history_backend():
+    if HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryBackend(HISTORY_DB_PATH)
+    return JsonHistoryBackend()
+
+
+def migrate_json_history(storage_dir: str = "chat_history", db_path: str = HISTORY_DB_PATH) -> Dict[str, int]:
+    """
+    Разовый перенос истории из файлов chat_history/*.json (и журналов) в базу SQLite.
+    Чаты, которые уже есть в базе, пропускаются, поэтому повторный запуск безопасен.
+    """
+    source = JsonHistoryBackend(storage_dir)
+    # Переносим всё, что сохранено в файлах, а не только то, что держится в памяти
+    source.max_messages = HISTORY_DB_MAX_MESSAGES
+    target = SqliteHistoryBackend(db_path)
+    stats = {'chats': 0, 'messages': 0, 'skipped': 0}
+    try:
+        existing = set(target.chat_ids())
+        for chat_id in source.chat_ids():
+            if chat_id in existing:
+                stats['skipped'] += 1
+                continue
+            messages = source.load(chat_id)
+            if not messages:
+                continue
+            target.write({chat_id: [{'op': 'add', 'message': message} for message in messages]})
+            stats['chats'] += 1
+            stats['messages'] += len(messages)
+    finally:
+        target.close()
+    return stats
+
+
+class ChatHistoryManager:
+    """
+    История чатов: кеш в памяти поверх подключаемого хранилища (backend).
+
+    Новые сообщения сначала попадают в буфер и сбрасываются в хранилище пачками в фоновом
+    потоке (write-behind). Хранилища — JsonHistoryBackend (файлы на чат, по умолчанию) и
+    SqliteHistoryBackend (одна база в режиме WAL), выбор — HISTORY_BACKEND.
+
+    История чата загружается из хранилища при первом обращении; в памяти держится не более
+    ``max_resident_chats`` чатов, давно не использовавшиеся вытесняются после сброса.
+    """
+
+    def __init__(self, storage_dir: str = "chat_history", flush_interval: float = 1.0,
+                 compact_threshold: Optional[int] = None, max_resident_chats: int = 1000,
+                 backend=None):
+        self.max_messages_per_chat = 50
+        self.backend = backend or JsonHistoryBackend(storage_dir, self.max_messages_per_chat, compact_threshold)
+        # Порядок ключей — порядок использования (LRU): последние использованные в конце
+        self.chat_histories: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self.max_resident_chats = max_resident_chats
+        self.flush_interval = flush_interval
+        self._pending: Dict[str, List[Dict]] = {}
+        # Чаты, записи которых сейчас пишутся в хранилище
+        self._in_flight: set = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    def load_all_histories(self):
+        """Принудительная загрузка всех чатов (при обычной работе история грузится лениво)"""
+        for chat_id in self.backend.chat_ids():
+            self.load_chat_history(chat_id)
+
+    def load_chat_history(self, chat_id: str):
+        """Загрузка истории конкретного чата из хранилища"""
+        with metrics.timer('history_load'):
+            self.chat_histories[chat_id] = self.backend.load(chat_id)[-self.max_messages_per_chat:]
+
+    def _ensure_loaded(self, chat_id: str) -> List[Dict]:
+        """Возвращает историю чата, при необходимости подгружая её из хранилища"""
+        if chat_id in self.chat_histories:
+            self.chat_histories.move_to_end(chat_id)
+        else:
+            self.load_chat_history(chat_id)
+            self._evict(keep=chat_id)
+        return self.chat_histories[chat_id]
+
+    def _is_dirty(self, chat_id: str) -> bool:
+        return chat_id in self._pending or chat_id in self._in_flight
+
+    def _evict(self, keep: Optional[str] = None):
+        """Вытеснение давно не использовавшихся чатов, уже сброшенных в хранилище"""
+        overflow = len(self.chat_histories) - self.max_resident_chats
+        if overflow <= 0:
+            return
+
+        # Несохранённые чаты пропускаем: их вытеснит следующий вызов после flush()
+        candidates = [c for c in self.chat_histories if c != keep and not self._is_dirty(c)]
+        for chat_id in candidates[:overflow]:
+            del self.chat_histories[chat_id]
+            self.backend.forget(chat_id)
 
     def save_chat_history(self, chat_id: str):
+        """Немедленная запись накопленных сообщений чата и сворачивание хранилища (синхронно)"""
         if chat_id not in self.chat_histories:
             return
 
-        file_path = self._get_chat_file_path(chat_id)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(self.chat_histories[chat_id], f, ensure_ascii=False, indent=2)
+        records = self._pending.pop(chat_id, None)
+        if records:
+            self.backend.write({chat_id: records})
+        self.backend.compact(chat_id)
+
+    def _append_record(self, chat_id: str, record: Dict):
+        self._pending.setdefault(chat_id, []).append(record)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет цикла событий (например, при использовании из скрипта) — пишем сразу
+            self.flush_sync()
+            return
 
-    def add_message(self, chat_id: str, user_id: str, message: str, username: Optional[str] = None, is_bot: bool = False):
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: loop.create_task(self.flush())
+            )
+
+    async def flush(self):
+        """Сброс накопленных записей в хранилище в фоновом потоке"""
+        self._flush_handle = None
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            self._in_flight = set(pending)
+            try:
+                with metrics.timer('history_flush'):
+                    await asyncio.to_thread(self.backend.write, pending)
+            except Exception as e:
+                metrics.inc('bot_errors_total', where='history_flush')
+                logging.error(f"Ошибка при сохранении истории: {e}")
+                # Пачку не теряем: вернём её в буфер перед более новыми записями и повторим позже
+                self._restore_pending(pending)
+                self._schedule_flush()
+                return
+            finally:
+                self._in_flight = set()
+            self._evict()
+
+    def _restore_pending(self, pending: Dict[str, List[Dict]]):
+        for chat_id, records in pending.items():
+            self._pending[chat_id] = records + self._pending.get(chat_id, [])
+
+    def flush_sync(self):
+        """Синхронный сброс буфера (для завершения работы без цикла событий)"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                self.backend.write(pending)
+            except Exception:
+                self._restore_pending(pending)
+                raise
+        self._evict()
+
+    async def close(self):
+        """Сброс всех несохранённых сообщений при остановке бота"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        await self.flush()
+        await asyncio.to_thread(self.backend.close)
+
+    def add_message(self, chat_id: str, user_id: str, message: str, username: Optional[str] = None,
+                    is_bot: bool = False) -> Optional[Dict]:
         """
         Добавление сообщения в историю (как пользователя, так и бота)
 
@@ -100,13 +1035,15 @@ class ChatHistoryManager:
             message (str): Текст сообщения
             username (str, optional): Имя пользователя
             is_bot (bool): Является ли сообщение от бота
+
+        Returns:
+            Optional[Dict]: сохранённая запись или None, если сообщение отброшено как дубликат
         """
-        if chat_id not in self.chat_histories:
-            self.chat_histories[chat_id] = []
+        history = self._ensure_loaded(chat_id)
 
         # Проверяем дубликаты
-        if self.chat_histories[chat_id] and self.chat_histories[chat_id][-1]['text'] == message:
-            return
+        if history and history[-1]['text'] == message:
+            return None
 
         message_data = {
             'text': message,
@@ -121,36 +1058,1137 @@ class ChatHistoryManager:
         if len(self.chat_histories[chat_id]) > self.max_messages_per_chat:
             self.chat_histories[chat_id] = self.chat_histories[chat_id][-self.max_messages_per_chat:]
 
-        self.save_chat_history(chat_id)
+        self._append_record(chat_id, {'op': 'add', 'message': message_data})
+        return message_data
 
-    def get_chat_history(self, chat_id: str, limit: int = 10) -> List[Dict]:
+    def get_chat_history(self, chat_id: str, limit: int = 10, exclude: Optional[List[Dict]] = None) -> List[Dict]:
         """
         Получение истории сообщений чата
 
         Args:
             chat_id (str): ID чата
             limit (int): Максимальное количество возвращаемых сообщений
+            exclude (List[Dict], optional): Записи, которые не нужно возвращать (сравниваются по времени
+                и тексту, поэтому переживают выгрузку чата из памяти). Без него не возвращается
+                последнее сообщение — считается, что это текущее
 
         Returns:
             List[Dict]: Список последних сообщений в чате
         """
-        if chat_id not in self.chat_histories:
-            return []
-
-        messages = self.chat_histories[chat_id]
+        messages = self._ensure_loaded(chat_id)
+        if exclude is not None:
+            skip = {(m['timestamp'], m['text']) for m in exclude}
+            return [m for m in messages if (m['timestamp'], m['text']) not in skip][-limit:]
         if len(messages) > 1:
             return messages[-limit-1:-1]
         return []
 
     def clear_chat_history(self, chat_id: str):
         """Очистка истории конкретного чата"""
-        if chat_id in self.chat_histories:
-            self.chat_histories[chat_id] = []
-            self.save_chat_history(chat_id)
+        self._ensure_loaded(chat_id)
+        self.chat_histories[chat_id] = []
+        self._append_record(chat_id, {'op': 'clear'})
+
+
+class ChatSettingsStore:
+    """
+    Настройки чатов (триггеры, стиль, системные инструкции), переживающие перезапуск.
+
+    Хранятся в двух файлах: снимок ``chat_settings.json`` со всеми чатами и журнал
+    ``chat_settings.journal``, в который изменения дописываются пачками в фоновом потоке
+    (write-behind) — обработка сообщений на диск не пишет. Журнал сворачивается в снимок,
+    когда разрастается, и при остановке, так что следующий запуск читает один небольшой файл.
+    Файлы читаются при первом обращении к настройкам; при этом подтягиваются более свежие копии
+    чатов из снимков других раскладок по шардам, так что смена SHARD_WORKERS ничего не теряет.
+    """
+
+    def __init__(self, path: str = SETTINGS_PATH, flush_interval: float = SETTINGS_FLUSH_INTERVAL,
+                 compact_threshold: int = 200, shared_path: Optional[str] = SETTINGS_PATH, owns=None):
+        self.path = path
+        # При загрузке сливаем общий снимок и снимки всех раскладок по шардам (chat_settings.shard<N>.json):
+        # после смены SHARD_WORKERS чат берётся из файла, где он менялся последним.
+        # owns(chat_id) -> bool ограничивает слияние чатами этого обработчика
+        self.shared_path = shared_path
+        self.owns = owns
+        self.journal_path = self._journal_path(path)
+        self.flush_interval = flush_interval
+        self.compact_threshold = compact_threshold
+        self._settings: Optional[Dict[str, Dict[str, Any]]] = None
+        self._pending: List[Dict[str, Any]] = []
+        self._journal_size = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    @staticmethod
+    def _journal_path(path: str) -> str:
+        return f"{os.path.splitext(path)[0]}.journal"
+
+    def _ensure_loaded(self) -> Dict[str, Dict[str, Any]]:
+        if self._settings is None:
+            self._settings = self._load()
+        return self._settings
+
+    def _sibling_paths(self) -> List[str]:
+        """Снимки общего хранилища и всех шардов, включая те, от которых остался только журнал"""
+        root, ext = os.path.splitext(self.shared_path)
+        paths = {self.shared_path}
+        for name in glob.glob(f"{glob.escape(root)}.shard*"):
+            base, suffix = os.path.splitext(name)
+            if suffix in (ext, '.journal'):
+                paths.add(base + ext)
+        own = os.path.abspath(self.path)
+        return sorted(path for path in paths if os.path.abspath(path) != own)
+
+    def _read(self, path: str):
+        """Снимок и его журнал: (настройки, число записей журнала)"""
+        settings: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logging.error(f"Ошибка чтения настроек чатов {path}: {e}")
+
+        records = 0
+        journal_path = self._journal_path(path)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная строка после аварийного завершения
+                        continue
+                    records += 1
+                    self._apply(settings, record)
+        return settings, records
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        settings, self._journal_size = self._read(self.path)
+        if not self.shared_path:
+            return settings
+
+        merged = 0
+        for path in self._sibling_paths():
+            other, _ = self._read(path)
+            for chat_id, chat in other.items():
+                if self.owns is not None and not self.owns(chat_id):
+                    continue
+                if chat_id not in settings or chat.get('_updated', 0) > settings[chat_id].get('_updated', 0):
+                    settings[chat_id] = chat
+                    merged += 1
+        if merged:
+            logging.info(f"Настройки {merged} чатов взяты из других раскладок шардов")
+            # Перенесённые чаты попадут в собственный снимок при остановке
+            self._journal_size += merged
+        return settings
+
+    @staticmethod
+    def _apply(settings: Dict[str, Dict[str, Any]], record: Dict[str, Any]):
+        chat = settings.setdefault(record['chat_id'], {})
+        if record['value'] is None:
+            chat.pop(record['key'], None)
+        else:
+            chat[record['key']] = record['value']
+        # Время изменения: при слиянии раскладок побеждает более свежая копия чата.
+        # Чат без настроек остаётся с отметкой, чтобы удаление не откатывалось старой копией
+        chat['_updated'] = record.get('ts', chat.get('_updated', 0))
+
+    def get(self, chat_id: str, key: str, default=None):
+        return self._ensure_loaded().get(chat_id, {}).get(key, default)
+
+    def set(self, chat_id: str, key: str, value):
+        """Изменение настройки чата (None — удалить); на диск попадёт при следующем сбросе"""
+        record = {'chat_id': chat_id, 'key': key, 'value': value, 'ts': time.time()}
+        self._apply(self._ensure_loaded(), record)
+        self._pending.append(record)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Нет цикла событий — пишем сразу
+            self.flush_sync()
+            return
+
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: loop.create_task(self.flush())
+            )
+
+    def _take_batch(self):
+        pending, self._pending = self._pending, []
+        journal_size = self._journal_size
+        self._journal_size += len(pending)
+        snapshot = None
+        if self._journal_size >= self.compact_threshold:
+            snapshot = json.loads(json.dumps(self._settings))
+            self._journal_size = 0
+        return pending, snapshot, journal_size
+
+    def _restore_batch(self, pending: List[Dict[str, Any]], journal_size: int):
+        """Пачка не записалась: возвращаем её перед более новыми изменениями"""
+        self._pending = pending + self._pending
+        self._journal_size = journal_size
+
+    def _write_batch(self, pending: List[Dict[str, Any]], snapshot: Optional[Dict[str, Dict[str, Any]]]):
+        if snapshot is not None:
+            # Снимок уже содержит все изменения пачки
+            self._write_snapshot(snapshot)
+            return
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in pending))
+
+    def _write_snapshot(self, snapshot: Dict[str, Dict[str, Any]]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    async def flush(self):
+        """Сброс накопленных изменений на диск в фоновом потоке"""
+        self._flush_handle = None
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, snapshot, journal_size = self._take_batch()
+            try:
+                await asyncio.to_thread(self._write_batch, pending, snapshot)
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении настроек чатов: {e}")
+                # Как и в истории: изменения не теряем, повторим позже
+                self._restore_batch(pending, journal_size)
+                self._schedule_flush()
+
+    def flush_sync(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            pending, snapshot, journal_size = self._take_batch()
+            try:
+                self._write_batch(pending, snapshot)
+            except Exception:
+                self._restore_batch(pending, journal_size)
+                raise
+
+    async def close(self):
+        """Сброс изменений и сворачивание журнала в снимок для быстрого следующего запуска"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        await self.flush()
+        if self._flush_handle is not None:
+            # Сброс не удался и запланирован повтор — последняя попытка ниже, снимком
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._settings is not None and (self._journal_size or self._pending):
+            # Снимок содержит и изменения, которые не удалось дописать в журнал
+            snapshot = json.loads(json.dumps(self._settings))
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+            self._journal_size = 0
+            self._pending = []
+
+
+class UploadedImageCache:
+    """
+    Кеш изображений, уже загруженных в Gemini File API.
+
+    Ключи — ``tg:<file_unique_id>`` из Telegram и ``sha:<sha256>`` содержимого (на случай, если
+    та же картинка пришла новым файлом). Записи живут до истечения удалённого файла, число
+    записей ограничено (LRU), кеш сохраняется на диск, чтобы переживать перезапуск.
+
+    Мелкие картинки, которые уходят в запрос встроенными байтами, хранятся здесь же вместе с
+    байтами (put_inline): это отдельный LRU в памяти размером не больше inline_budget байт,
+    на диск он не пишется. Повтор такой картинки тоже не скачивается из Telegram.
+    """
+
+    def __init__(self, path: str = IMAGE_CACHE_PATH, max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+                 ttl: float = IMAGE_CACHE_TTL, save_interval: float = 5.0,
+                 inline_budget: int = IMAGE_CACHE_INLINE_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self.inline_budget = inline_budget
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Ключ -> {'mime_type', 'data', 'keys'}; одна запись на картинку под всеми её ключами
+        self._inline: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._inline_size = 0
+        self._dirty = False
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'inline_bytes': 0}
+        self.load()
+
+    @staticmethod
+    def telegram_key(file_unique_id: str) -> str:
+        return f"tg:{file_unique_id}"
+
+    @staticmethod
+    def content_key(data: bytes) -> str:
+        return f"sha:{hashlib.sha256(data).hexdigest()}"
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f"Не удалось прочитать кеш изображений: {e}")
+            return
+
+        now = time.time()
+        for key, entry in entries.items():
+            if entry.get('expires', 0) > now:
+                self._entries[key] = entry
+
+    def get(self, *keys: str) -> Optional[Dict[str, Any]]:
+        """Первая неистёкшая запись по любому из ключей"""
+        now = time.time()
+        for key in keys:
+            entry = self._inline.get(key)
+            if entry is not None:
+                self._inline.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry['expires'] <= now:
+                del self._entries[key]
+                self._mark_dirty()
+                continue
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, keys, uploaded_file, mime_type: str):
+        """Запоминает загруженный файл под всеми переданными ключами"""
+        expires = time.time() + self.ttl
+        expiration_time = getattr(uploaded_file, 'expiration_time', None)
+        if expiration_time is not None and hasattr(expiration_time, 'timestamp'):
+            # Час запаса, чтобы не сослаться на файл, который вот-вот удалят
+            expires = min(expires, expiration_time.timestamp() - 3600)
+
+        self.alias(keys, {
+            'name': uploaded_file.name,
+            'uri': uploaded_file.uri,
+            'mime_type': mime_type,
+            'expires': expires,
+        })
+
+    def alias(self, keys, entry: Dict[str, Any]):
+        """Запись под дополнительными ключами (срок жизни остаётся прежним)"""
+        for key in keys:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        self._mark_dirty()
+
+    def put_inline(self, keys, data: bytes, mime_type: str):
+        """Запоминает байты мелкой картинки под всеми ключами (LRU по суммарному размеру)"""
+        if len(data) > self.inline_budget:
+            return
+        entry = next((self._inline[key] for key in keys if key in self._inline), None)
+        if entry is None:
+            entry = {'mime_type': mime_type, 'data': data, 'keys': set()}
+            self._inline_size += len(data)
+        for key in keys:
+            other = self._inline.get(key)
+            if other is not None and other is not entry:
+                self._unlink_inline(key, other)
+            self._inline[key] = entry
+            self._inline.move_to_end(key)
+            entry['keys'].add(key)
+
+        while self._inline_size > self.inline_budget:
+            key, oldest = next(iter(self._inline.items()))
+            for alias in list(oldest['keys']):
+                self._unlink_inline(alias, oldest)
+            self.stats['evictions'] += 1
+        self.stats['inline_bytes'] = self._inline_size
+
+    def _unlink_inline(self, key: str, entry: Dict[str, Any]):
+        if self._inline.get(key) is entry:
+            del self._inline[key]
+        entry['keys'].discard(key)
+        if not entry['keys']:
+            self._inline_size -= len(entry['data'])
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self._mark_dirty()
+
+    def invalidate_uri(self, uri: str):
+        """Сброс всех ключей (tg: и sha:), ссылающихся на удалённый файл"""
+        self.invalidate(*[key for key, entry in self._entries.items() if entry.get('uri') == uri])
+
+    def _mark_dirty(self):
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(
+                self.save_interval, lambda: loop.create_task(self.save_async())
+            )
+
+    def _snapshot(self) -> Dict[str, Dict[str, Any]]:
+        self._dirty = False
+        return dict(self._entries)
+
+    def _write(self, entries: Dict[str, Dict[str, Any]]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    async def save_async(self):
+        self._save_handle = None
+        if not self._dirty:
+            return
+        try:
+            await asyncio.to_thread(self._write, self._snapshot())
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении кеша изображений: {e}")
+
+    def save(self):
+        """Синхронное сохранение (при остановке бота)"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._dirty:
+            self._write(self._snapshot())
+
+
+class _Broadcast:
+    """Куски одного стрима, которые раздаются всем подписчикам с начала"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def append(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            elif self.done:
+                if self.error:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+class ResponseCoalescer:
+    """
+    Объединение одинаковых запросов к модели (single-flight) и короткий кеш точных повторов.
+
+    Пока запрос с данным ключом выполняется, новые вызывающие ждут тот же результат вместо
+    отдельного вызова API. Успешные ответы хранятся ttl секунд (не больше max_entries).
+    Когда уходит последний ожидающий, запрос к модели отменяется и ничего не кешируется.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._calls: Dict[str, asyncio.Future] = {}
+        # Сколько вызывающих ждут каждый запрос из _calls
+        self._call_waiters: Dict[str, int] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'cancelled': 0}
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256('\x00'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+    def _cache_get(self, key: str):
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return value
+
+    def _cache_put(self, key: str, value):
+        if self.ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + self.ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def call(self, key: str, factory):
+        """Результат корутины factory(); успешные ответы ('success': True) кешируются"""
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.stats['hits'] += 1
+            return cached
+
+        task = self._calls.get(key)
+        if task is None:
+            self.stats['misses'] += 1
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+
+            def finished(t):
+                if self._calls.get(key) is t:
+                    del self._calls[key]
+                    self._call_waiters.pop(key, None)
+                if not t.cancelled() and t.exception() is None and t.result().get('success'):
+                    self._cache_put(key, t.result())
+
+            task.add_done_callback(finished)
+        else:
+            self.stats['coalesced'] += 1
+
+        self._call_waiters[key] = self._call_waiters.get(key, 0) + 1
+        try:
+            # Отмена одного ожидающего не должна отменять запрос для остальных
+            return await asyncio.shield(task)
+        finally:
+            if self._calls.get(key) is task:
+                self._call_waiters[key] -= 1
+                if not self._call_waiters[key] and not task.done():
+                    # Ждать больше некому — освобождаем слот и квоту
+                    del self._calls[key]
+                    del self._call_waiters[key]
+                    self.stats['cancelled'] += 1
+                    task.cancel()
+
+    async def stream(self, key: str, factory):
+        """Куски стрима factory(); все одновременные подписчики получают один и тот же стрим"""
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.stats['hits'] += 1
+            for chunk in cached:
+                yield chunk
+            return
+
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.stats['misses'] += 1
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.ensure_future(self._pump(key, broadcast, factory))
+        else:
+            self.stats['coalesced'] += 1
+
+        broadcast.subscribers += 1
+        try:
+            async for chunk in broadcast.subscribe():
+                yield chunk
+        finally:
+            broadcast.subscribers -= 1
+            if not broadcast.subscribers and not broadcast.done:
+                # Последний подписчик ушёл — генерацию дальше не ведём и не кешируем
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+                self.stats['cancelled'] += 1
+                broadcast.task.cancel()
+
+    async def _pump(self, key: str, broadcast: _Broadcast, factory):
+        try:
+            async for chunk in factory():
+                broadcast.append(chunk)
+        except Exception as e:
+            broadcast.finish(e)
+        else:
+            broadcast.finish()
+            self._cache_put(key, tuple(broadcast.chunks))
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = dict(self.stats)
+        stats['cached'] = len(self._cache)
+        stats['in_flight'] = len(self._calls) + len(self._streams)
+        return stats
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая локальная оценка числа токенов (для кириллицы ~3 символа на токен)"""
+    return len(text) // 3 + 1
+
+
+def is_quota_error(error: BaseException) -> bool:
+    """Ошибка превышения квоты Gemini (HTTP 429 / RESOURCE_EXHAUSTED) — по типу и коду, не по тексту"""
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    return getattr(error, 'code', None) == 429 or getattr(error, 'status_code', None) == 429
+
+
+def retry_after_hint(error: BaseException) -> Optional[float]:
+    """Задержка, которую сервер просит выдержать перед повтором (retry_delay / «retry in Ns»)"""
+    text = str(error)
+    match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', text) or re.search(r'retry in ([\d.]+)\s*s', text)
+    return float(match.group(1)) if match else None
+
+
+class QuotaScheduler:
+    """
+    Планировщик запросов к Gemini в пределах квоты.
+
+    Два токен-бакета (запросы и токены в минуту) выдают разрешения ожидающим строго по
+    приоритету, а внутри приоритета — по очереди. Ответ 429 ставит выдачу на паузу на
+    подсказанное сервером время (с разбросом, чтобы запросы не возвращались синхронно)
+    и временно снижает скорость пополнения; успешные ответы постепенно её восстанавливают.
+    """
+
+    def __init__(self, rpm: int = GEMINI_RPM, tpm: int = GEMINI_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._waiters: List[tuple] = []
+        self._order = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._paused_until = 0.0
+        self._quota_errors_in_row = 0
+        # Доля номинальной скорости пополнения бакетов (уменьшается после 429)
+        self.rate_factor = 1.0
+        self.stats = {'granted': 0, 'quota_errors': 0, 'paused_seconds': 0.0, 'total_wait': 0.0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60 * self.rate_factor)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60 * self.rate_factor)
+
+    def _dispatch(self):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        self._refill()
+        now = time.monotonic()
+        delay = 0.0
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self._paused_until:
+                delay = self._paused_until - now
+                break
+
+            # Запрос больше всего бакета иначе не прошёл бы никогда
+            tokens = min(tokens, self.tpm)
+            if self._requests >= 1 and self._tokens >= tokens:
+                heapq.heappop(self._waiters)
+                self._requests -= 1
+                self._tokens -= tokens
+                future.set_result(None)
+                continue
+
+            # Самый приоритетный ждёт пополнения; остальные за ним не обгоняют
+            request_rate = self.rpm / 60 * self.rate_factor
+            token_rate = self.tpm / 60 * self.rate_factor
+            delay = max((1 - self._requests) / request_rate, (tokens - self._tokens) / token_rate, 0.01)
+            break
+
+        if self._waiters and delay:
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, tokens: int = 1):
+        """Ожидание разрешения на запрос стоимостью tokens"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), tokens, future))
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Разрешение уже выдано, но запрос не состоится — возвращаем его в бакеты
+                self._requests += 1
+                self._tokens += tokens
+            self._dispatch()
+            raise
+        self.stats['granted'] += 1
+        self.stats['total_wait'] += time.monotonic() - started
+
+    def headroom(self) -> float:
+        """Доля оставшейся квоты: 1 — бакеты полны, 0 — исчерпаны или пауза после 429"""
+        self._refill()
+        if time.monotonic() < self._paused_until or self._waiters:
+            return 0.0
+        return max(0.0, min(self._requests / self.rpm, self._tokens / self.tpm))
+
+    def settle(self, estimated: int, actual: Optional[int]):
+        """Поправка бакета токенов по фактическому расходу из usage_metadata"""
+        if actual is not None:
+            self._tokens += estimated - actual
+
+    def on_success(self):
+        self._quota_errors_in_row = 0
+        self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    def on_quota_error(self, error: BaseException) -> float:
+        """Пауза для всех запросов после 429; возвращает её длительность"""
+        self.stats['quota_errors'] += 1
+        self._quota_errors_in_row += 1
+        self.rate_factor = max(0.1, self.rate_factor / 2)
+
+        delay = retry_after_hint(error) or min(60.0, 2.0 ** self._quota_errors_in_row)
+        delay *= random.uniform(1.0, 1.3)
+        now = time.monotonic()
+        if now + delay > self._paused_until:
+            self.stats['paused_seconds'] += now + delay - max(now, self._paused_until)
+            self._paused_until = now + delay
+        return delay
+
+    @staticmethod
+    async def backoff(error: BaseException, attempt: int):
+        """Пауза перед повторной попыткой"""
+        if is_quota_error(error):
+            # Ждать будем в acquire(): пауза общая для всех запросов
+            return
+        # Экспоненциальная задержка с полным разбросом
+        await asyncio.sleep(random.uniform(0, 2 ** attempt))
+
+    def get_stats(self) -> Dict[str, Any]:
+        self._refill()
+        stats = dict(self.stats)
+        stats.update({
+            'waiting': sum(1 for *_, future in self._waiters if not future.done()),
+            'requests_available': round(self._requests, 2),
+            'tokens_available': round(self._tokens),
+            'rate_factor': round(self.rate_factor, 2),
+            'paused_for': max(0.0, round(self._paused_until - time.monotonic(), 2)),
+        })
+        return stats
+
+
+def is_auth_error(error: BaseException) -> bool:
+    """Ключ отклонён сервером (недействителен, отозван, нет доступа)"""
+    if is_file_missing_error(error):
+        # 403 на удалённый файл File API — с ключом всё в порядке
+        return False
+    if getattr(error, 'code', None) in (401, 403):
+        return True
+    text = str(error)
+    return 'API_KEY_INVALID' in text or 'PERMISSION_DENIED' in text or 'API key not valid' in text
+
+
+class ApiKey:
+    """Ключ Gemini в пуле: собственная квота, имя модели и статистика"""
+
+    def __init__(self, api_key: str, model_name: Optional[str] = None, rpm: int = GEMINI_RPM,
+                 tpm: int = GEMINI_TPM):
+        self.api_key = api_key
+        self.model_name = model_name or GEMINI_MODEL_NAME
+        self.label = f"...{api_key[-4:]}" if api_key else "default"
+        self.scheduler = QuotaScheduler(rpm, tpm)
+        self.quarantined_until = 0.0
+        self.stats = {'requests': 0, 'tokens': 0, 'errors': 0, 'quota_errors': 0, 'auth_errors': 0}
+
+    def budget(self) -> float:
+        """Доля оставшейся квоты (0 — ключ на паузе или исчерпан)"""
+        return self.scheduler.headroom()
+
+
+class ApiKeyPool:
+    """
+    Пул ключей Gemini. Запрос уходит на ключ с наибольшим остатком квоты; ключи,
+    вернувшие 429, стоят на паузе своего планировщика, отклонённые как недействительные —
+    выводятся из ротации на GEMINI_AUTH_QUARANTINE секунд.
+    """
+
+    def __init__(self, keys):
+        self.keys: List[ApiKey] = []
+        for key in keys:
+            if isinstance(key, dict):
+                self.keys.append(ApiKey(
+                    key['api_key'],
+                    key.get('model'),
+                    key.get('rpm', GEMINI_RPM),
+                    key.get('tpm', GEMINI_TPM)
+                ))
+            else:
+                self.keys.append(ApiKey(key))
+
+    @property
+    def primary(self) -> ApiKey:
+        """Ключ, переданный в configure(): через него загружаются файлы"""
+        return self.keys[0]
+
+    def pick(self) -> ApiKey:
+        now = time.monotonic()
+        available = [key for key in self.keys if key.quarantined_until <= now]
+        if not available:
+            # Все ключи в карантине — берём тот, что освободится раньше
+            return min(self.keys, key=lambda k: k.quarantined_until)
+        return max(available, key=lambda k: k.budget())
+
+    def report_error(self, key: ApiKey, error: BaseException, logger: logging.Logger):
+        key.stats['errors'] += 1
+        if is_quota_error(error):
+            key.stats['quota_errors'] += 1
+            delay = key.scheduler.on_quota_error(error)
+            logger.warning(f"Quota exceeded for key {key.label}, pausing it for {delay:.1f}s")
+        elif is_auth_error(error):
+            key.stats['auth_errors'] += 1
+            key.quarantined_until = time.monotonic() + GEMINI_AUTH_QUARANTINE
+            logger.error(f"Key {key.label} rejected, quarantined for {GEMINI_AUTH_QUARANTINE:.0f}s")
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [{
+            'key': key.label,
+            'model': key.model_name,
+            'budget': round(key.budget(), 3),
+            'quarantined_for': max(0.0, round(key.quarantined_until - now, 1)),
+            **key.stats,
+            'scheduler': key.scheduler.get_stats(),
+        } for key in self.keys]
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: предохранитель разомкнут, Gemini считается недоступным"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для вызовов Gemini.
+
+    closed — запросы идут, исходы копятся в скользящем окне; при высокой доле ошибок и
+    медленных ответов переходит в open — все запросы сразу отклоняются. Через open_for
+    секунд — half_open: пропускается один пробный запрос, его успех замыкает цепь,
+    ошибка снова размыкает. Квотные (429) и ошибки ключа на состояние не влияют.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_ratio: float = CIRCUIT_FAILURE_RATIO, min_calls: int = CIRCUIT_MIN_CALLS,
+                 window: float = CIRCUIT_WINDOW, slow_call: float = CIRCUIT_SLOW_CALL,
+                 open_for: float = CIRCUIT_OPEN_FOR):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.state = self.CLOSED
+        self._calls: deque = deque()
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.stats = {'opened': 0, 'rejected': 0, 'failures': 0, 'slow_calls': 0}
+        self.logger = logging.getLogger('circuit_breaker')
+
+    def is_open(self) -> bool:
+        """Разомкнут ли предохранитель прямо сейчас (без расхода пробного запроса)"""
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at < self.open_for
+        return self.state == self.HALF_OPEN and self._probe_in_flight
+
+    def acquire(self) -> bool:
+        """Разрешение на вызов; возвращает True, если это пробный вызов в half_open"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_for:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError("Gemini temporarily unavailable (circuit open)")
+            self.state = self.HALF_OPEN
+            self.logger.warning("Circuit half-open, sending a probe request")
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError("Gemini temporarily unavailable (probe in flight)")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record(self, failed: Optional[bool], latency: float, probe: bool):
+        """Исход вызова: failed=None — нейтральный (квота, отмена), на состояние не влияет"""
+        if failed is not None and latency >= self.slow_call:
+            self.stats['slow_calls'] += 1
+            failed = True
+        if failed:
+            self.stats['failures'] += 1
+
+        if probe:
+            self._probe_in_flight = False
+            if failed:
+                self._open()
+            elif failed is not None:
+                self.state = self.CLOSED
+                self._calls.clear()
+                self.logger.warning("Circuit closed, Gemini is responding again")
+            return
+
+        if failed is None or self.state != self.CLOSED:
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, failed))
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+        failures = sum(1 for _, f in self._calls if f)
+        if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_ratio:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self.stats['opened'] += 1
+        self.logger.error(f"Circuit opened, failing fast for {self.open_for:g}s")
+
+    def get_state(self) -> Dict[str, Any]:
+        state = dict(self.stats)
+        state['state'] = self.state
+        state['open_for'] = max(0.0, round(self._opened_at + self.open_for - time.monotonic(), 1)) \
+            if self.state == self.OPEN else 0.0
+        state['recent_calls'] = len(self._calls)
+        state['recent_failures'] = sum(1 for _, f in self._calls if f)
+        return state
+
+
+class StreamTimeout(Exception):
+    """Стрим ответа модели не уложился в отведённое время"""
+
+
+def is_file_missing_error(error: BaseException) -> bool:
+    """Запрос сослался на файл File API, которого уже нет (удалён или истёк)"""
+    text = str(error).lower()
+    if not re.search(r'\bfiles?\b', text):
+        return False
+    return getattr(error, 'code', None) in (403, 404) or 'not exist' in text or 'not found' in text
+
+
+def is_cache_miss_error(error: BaseException) -> bool:
+    """Запрос сослался на кеш контекста, которого на сервере уже нет"""
+    text = str(error).lower()
+    # Только ресурс cachedContents/...: 404 на модель или эндпоинт пересоздание кеша не исправит
+    if 'cachedcontent' not in text:
+        return False
+    return getattr(error, 'code', None) == 404 or 'not found' in text
+
+
+class GeminiContextCacheBackend:
+    """Кеш контекста на стороне Gemini (CachedContent); все методы блокирующие"""
+
+    available = caching is not None
+
+    def create(self, model_name: str, system_instruction: str, ttl: float):
+        if not model_name.startswith('models/'):
+            model_name = f"models/{model_name}"
+        return caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            ttl=timedelta(seconds=ttl)
+        )
+
+    def refresh(self, handle, ttl: float):
+        handle.update(ttl=timedelta(seconds=ttl))
+
+    def delete(self, handle):
+        handle.delete()
+
+    def model(self, handle, generation_config: Optional[GenConfig]) -> GenerativeModel:
+        return GenerativeModel.from_cached_content(cached_content=handle, generation_config=generation_config)
+
+
+class FakeContextCacheBackend:
+    """
+    Локальная замена кеша контекста без сети: записи живут в памяти и истекают по TTL,
+    модель создаётся с теми же инструкциями. Позволяет проверить создание, продление,
+    истечение и откат на обычные запросы без обращения к Gemini.
+    """
+
+    available = True
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.calls = {'create': 0, 'refresh': 0, 'delete': 0}
+        self._ids = itertools.count(1)
+
+    def _entry(self, handle: str) -> Dict[str, Any]:
+        entry = self.entries.get(handle)
+        if entry is None or entry['expires_at'] <= time.time():
+            self.entries.pop(handle, None)
+            raise LookupError(f"CachedContent {handle} not found")
+        return entry
+
+    def create(self, model_name: str, system_instruction: str, ttl: float) -> str:
+        self.calls['create'] += 1
+        if self.fail:
+            raise RuntimeError("Context caching is not available")
+        handle = f"cachedContents/fake-{next(self._ids)}"
+        self.entries[handle] = {
+            'model_name': model_name,
+            'system_instruction': system_instruction,
+            'expires_at': time.time() + ttl,
+        }
+        return handle
+
+    def refresh(self, handle: str, ttl: float):
+        self.calls['refresh'] += 1
+        self._entry(handle)['expires_at'] = time.time() + ttl
+
+    def delete(self, handle: str):
+        self.calls['delete'] += 1
+        self.entries.pop(handle, None)
+
+    def model(self, handle: str, generation_config: Optional[GenConfig]) -> GenerativeModel:
+        entry = self._entry(handle)
+        return GenerativeModel(
+            model_name=entry['model_name'],
+            generation_config=generation_config,
+            system_instruction=entry['system_instruction']
+        )
+
+
+class ContextCache:
+    """
+    Кеш системных инструкций на стороне сервера.
+
+    Для каждой пары (модель, инструкции) создаётся одна запись кеша, которая переиспользуется
+    всеми запросами и продлевается, пока ею пользуются; неиспользуемые записи истекают сами.
+    Если инструкции слишком короткие, кеширование недоступно или сервер вернул ошибку,
+    возвращается None и запрос уходит обычным образом.
+    """
+
+    def __init__(self, backend, ttl: float = CONTEXT_CACHE_TTL, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS,
+                 retry_after: float = CONTEXT_CACHE_RETRY_AFTER, timeout: float = 10.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.retry_after = retry_after
+        self.timeout = timeout
+        # (модель, хеш инструкций) -> {'handle', 'expires_at', 'models': {конфиг: GenerativeModel}}
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+        self._locks: Dict[tuple, asyncio.Lock] = {}
+        self._unavailable_until = 0.0
+        self.stats = {'hits': 0, 'created': 0, 'refreshed': 0, 'skipped': 0, 'fallbacks': 0, 'invalidated': 0}
+        self.logger = logging.getLogger('context_cache')
+
+    @staticmethod
+    def _key(model_name: str, system_instruction: str) -> tuple:
+        return model_name, hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+
+    async def _call(self, func, *args):
+        return await asyncio.wait_for(asyncio.to_thread(func, *args), timeout=self.timeout)
+
+    async def model_for(self, model_name: str, system_instruction: str,
+                        generation_config: Optional[GenConfig]) -> Optional[GenerativeModel]:
+        """Модель поверх записи кеша для этих инструкций или None, если кеш использовать нельзя"""
+        if not self.backend.available or estimate_tokens(system_instruction) < self.min_tokens:
+            self.stats['skipped'] += 1
+            return None
+        if time.monotonic() < self._unavailable_until:
+            self.stats['fallbacks'] += 1
+            return None
+
+        key = self._key(model_name, system_instruction)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            try:
+                if entry is not None and entry['expires_at'] - now < self.ttl / 10:
+                    # Запись скоро истечёт, а ею пользуются — продлеваем
+                    try:
+                        await self._call(self.backend.refresh, entry['handle'], self.ttl)
+                        entry['expires_at'] = time.monotonic() + self.ttl
+                        self.stats['refreshed'] += 1
+                    except Exception as e:
+                        self.logger.warning(f"Context cache refresh failed, recreating: {e}")
+                        self._entries.pop(key, None)
+                        entry = None
+
+                if entry is None:
+                    handle = await self._call(self.backend.create, model_name, system_instruction, self.ttl)
+                    entry = {'handle': handle, 'expires_at': time.monotonic() + self.ttl, 'models': {}}
+                    self._entries[key] = entry
+                    self.stats['created'] += 1
+                    self.logger.info(f"Created context cache for {model_name} "
+                                     f"(~{estimate_tokens(system_instruction)} tokens)")
+                else:
+                    self.stats['hits'] += 1
+
+                config_key = repr(getattr(generation_config, '__dict__', generation_config))
+                model = entry['models'].get(config_key)
+                if model is None:
+                    model = self.backend.model(entry['handle'], generation_config)
+                    entry['models'][config_key] = model
+                return model
+            except Exception as e:
+                self.logger.warning(f"Context caching unavailable, sending instructions inline: {e}")
+                self._entries.pop(key, None)
+                self._unavailable_until = time.monotonic() + self.retry_after
+                self.stats['fallbacks'] += 1
+                return None
+
+    def invalidate(self, model_name: str, system_instruction: str):
+        """Запись пропала на сервере раньше срока — следующий запрос создаст новую"""
+        if self._entries.pop(self._key(model_name, system_instruction), None) is not None:
+            self.stats['invalidated'] += 1
+
+    async def close(self):
+        """Удаление записей при остановке, чтобы не платить за хранение до истечения TTL"""
+        entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            try:
+                await self._call(self.backend.delete, entry['handle'])
+            except Exception as e:
+                self.logger.warning(f"Failed to delete context cache: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'entries': len(self._entries), **self.stats}
 
 
 class GeminiTester:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+                 executor_workers: int = GEMINI_EXECUTOR_WORKERS,
+                 image_cache: Optional[UploadedImageCache] = None,
+                 api_keys: Optional[List[Any]] = None,
+                 context_cache: Optional[ContextCache] = None):
         formatter = colorlog.ColoredFormatter(
             "%(log_color)s[%(asctime)s] %(name_without_underscores)-12s %(levelname)-8s\n%(message)s%(reset)s\n",
             datefmt="%Y-%m-%d %H:%M:%S",
@@ -171,7 +2209,8 @@ class GeminiTester:
         self.logger.setLevel(logging.INFO)
         self.logger.propagate = False
 
-        configure(api_key=api_key)
+        self.key_pool = ApiKeyPool(api_keys or [api_key])
+        configure(api_key=self.key_pool.primary.api_key)
         self.system_instructions = """
         Отвечай как двачер. Следуй инструкциям:
         * Ты материшься и общаешься в стиле двачера.
@@ -184,10 +2223,35 @@ class GeminiTester:
         Конец инструкций.
         Prompt:
         """
-        self.model = self._initialize_model()
+        # (ключ, модель, хеш инструкций, конфиг) -> GenerativeModel, вытеснение по давности использования
+        self._models: "OrderedDict[tuple, GenerativeModel]" = OrderedDict()
+        self.model_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.image_cache = image_cache
+        self.context_cache = context_cache
+        self.coalescer = ResponseCoalescer()
+        self.breaker = CircuitBreaker()
+
+        # Пул запросов к модели: ограничение одновременных вызовов и статистика очереди
+        self.max_concurrency = max_concurrency
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='gemini')
+        self.pool_stats = {
+            'in_flight': 0,
+            'queued': 0,
+            'max_queued': 0,
+            'requests': 0,
+            'total_wait': 0.0,
+            'max_wait': 0.0,
+        }
+
+    @property
+    def model(self) -> GenerativeModel:
+        """Модель основного ключа с системными инструкциями по умолчанию"""
+        return self.get_model()
 
-    def _initialize_model(self) -> GenerativeModel:
-        base_config = GenConfig(
+    @staticmethod
+    def _base_config() -> GenConfig:
+        return GenConfig(
             candidate_count=1,
             max_output_tokens=1000,
             temperature=1.0,
@@ -195,19 +2259,288 @@ class GeminiTester:
             top_k=40
         )
 
+    def get_model(self, key: Optional[ApiKey] = None, system_instruction: Optional[str] = None,
+                  generation_config: Optional[GenConfig] = None) -> GenerativeModel:
+        """
+        Экземпляр модели для ключа и системных инструкций (None — инструкции по умолчанию).
+
+        Модели создаются один раз и переиспользуются, поэтому чаты со своими инструкциями
+        не пересоздают модель на каждый запрос и не подменяют её друг другу.
+        """
+        key = key or self.key_pool.primary
+        instruction = self.system_instructions if system_instruction is None else system_instruction
+        config = generation_config or self._base_config()
+        cache_key = (
+            key.api_key,
+            key.model_name,
+            hashlib.sha256(instruction.encode('utf-8')).hexdigest(),
+            repr(getattr(config, '__dict__', config))
+        )
+
+        model = self._models.get(cache_key)
+        if model is not None:
+            self._models.move_to_end(cache_key)
+            self.model_cache_stats['hits'] += 1
+            return model
+
+        self.model_cache_stats['misses'] += 1
+        model = self._initialize_model(key.model_name, instruction, config)
+        if key is not self.key_pool.primary:
+            self._bind_client(model, key.api_key)
+        self._models[cache_key] = model
+        while len(self._models) > MODEL_CACHE_MAX_ENTRIES:
+            self._models.popitem(last=False)
+            self.model_cache_stats['evictions'] += 1
+        return model
+
+    @staticmethod
+    def _bind_client(model: GenerativeModel, api_key: str):
+        # SDK берёт клиента из глобального configure(); для остальных ключей подставляем собственного
+        options = ClientOptions(api_key=api_key)
+        model._client = glm.GenerativeServiceClient(client_options=options)
+        model._async_client = glm.GenerativeServiceAsyncClient(client_options=options)
+
+    def _initialize_model(self, model_name: str = GEMINI_MODEL_NAME, system_instruction: Optional[str] = None,
+                          generation_config: Optional[GenConfig] = None) -> GenerativeModel:
+        base_config = generation_config or self._base_config()
+
         self.logger.info(f"Initializing model with config: {base_config}")
 
         return GenerativeModel(
-            model_name="gemini-1.5-flash-002",
+            model_name=model_name,
             generation_config=base_config,
-            system_instruction=self.system_instructions  # Правильный способ установки системных инструкций
+            # Правильный способ установки системных инструкций
+            system_instruction=self.system_instructions if system_instruction is None else system_instruction
+        )
+
+    @asynccontextmanager
+    async def _model_slot(self, priority: int = PRIORITY_NORMAL, tokens: int = 1, key: Optional[ApiKey] = None,
+                          system_instruction: Optional[str] = None):
+        """
+        Занимает место в пуле запросов к модели: выбирает ключ (или берёт указанный),
+        ждёт разрешения его планировщика квоты, затем свободный слот. Отдаёт словарь с
+        моделью выбранного ключа и инструкций ('model'), куда вызывающий код кладёт
+        фактический расход токенов ('total_tokens').
+        """
+        # Во время сбоя Gemini отказываем сразу, не занимая очередь
+        probe = self.breaker.acquire()
+        stats = self.pool_stats
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        started = time.monotonic()
+        key = key or self.key_pool.pick()
+        instruction = self.system_instructions if system_instruction is None else system_instruction
+        cached = False
+        try:
+            model = self.get_model(key, instruction)
+            # Записи кеша контекста создаются через основной ключ и доступны только ему
+            if self.context_cache is not None and key is self.key_pool.primary:
+                cached_model = await self.context_cache.model_for(key.model_name, instruction, self._base_config())
+                if cached_model is not None:
+                    model, cached = cached_model, True
+            await key.scheduler.acquire(priority, tokens)
+            await self._slots.acquire()
+        except BaseException:
+            self.breaker.record(None, 0.0, probe)
+            raise
+        finally:
+            stats['queued'] -= 1
+
+        waited = time.monotonic() - started
+        metrics.stage('gemini_wait', waited)
+        stats['requests'] += 1
+        stats['total_wait'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+        if waited > 1.0:
+            self.logger.warning(f"Waited {waited:.2f}s for quota and a free model slot ({stats['queued']} still queued)")
+
+        usage: Dict[str, Any] = {'model': model, 'cached_context': cached}
+        stats['in_flight'] += 1
+        key.stats['requests'] += 1
+        call_started = time.monotonic()
+        failed = None
+        try:
+            yield usage
+        except Exception as e:
+            if cached and is_cache_miss_error(e):
+                # Кеш истёк на сервере раньше срока: повторная попытка создаст новый
+                self.context_cache.invalidate(key.model_name, instruction)
+                metrics.inc('bot_gemini_requests_total', outcome='cache_miss')
+                raise
+            self.key_pool.report_error(key, e, self.logger)
+            if is_quota_error(e):
+                metrics.inc('bot_gemini_requests_total', outcome='quota')
+            elif is_auth_error(e):
+                metrics.inc('bot_gemini_requests_total', outcome='auth')
+            else:
+                metrics.inc('bot_gemini_requests_total', outcome='error')
+                failed = True
+            raise
+        else:
+            failed = False
+            key.scheduler.on_success()
+            metrics.inc('bot_gemini_requests_total', outcome='ok')
+        finally:
+            metrics.stage('gemini_total', time.monotonic() - call_started)
+            for kind in ('prompt', 'output', 'total'):
+                if usage.get(f'{kind}_tokens'):
+                    metrics.inc('bot_gemini_tokens_total', usage[f'{kind}_tokens'], kind=kind)
+            self.breaker.record(failed, time.monotonic() - call_started, probe)
+            stats['in_flight'] -= 1
+            self._slots.release()
+            key.scheduler.settle(tokens, usage.get('total_tokens'))
+            key.stats['tokens'] += usage.get('total_tokens') or 0
+
+    @staticmethod
+    def _record_usage(usage: Dict[str, Any], response):
+        # В стриме каждый чанк несёт накопленные значения — последнее и есть итог
+        metadata = getattr(response, 'usage_metadata', None)
+        for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count'),
+                            ('total', 'total_token_count')):
+            value = getattr(metadata, field, None)
+            if value:
+                usage[f'{kind}_tokens'] = value
+
+    def _run_blocking(self, func, *args, **kwargs):
+        """Выполнение блокирующего вызова SDK в собственном пуле потоков (а не в общем executor)"""
+        return asyncio.get_running_loop().run_in_executor(self._executor, lambda: func(*args, **kwargs))
+
+    async def _generate(self, contents, priority: int = PRIORITY_NORMAL, tokens: int = 1,
+                        system_instruction: Optional[str] = None, **kwargs):
+        """Нестриминговый вызов модели: асинхронный API SDK, если он есть, иначе собственный пул потоков"""
+        async with self._model_slot(priority, tokens, system_instruction=system_instruction) as usage:
+            model = usage['model']
+            if hasattr(model, 'generate_content_async'):
+                response = await model.generate_content_async(contents, **kwargs)
+            else:
+                response = await self._run_blocking(model.generate_content, contents, **kwargs)
+            self._record_usage(usage, response)
+            return response
+
+    async def _iterate_in_thread(self, iterable):
+        """Чтение синхронного стрима SDK в фоновом потоке, чтобы не блокировать цикл событий"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # Цикл событий уже закрыт
+                stop.set()
+
+        def reader():
+            try:
+                for item in iterable:
+                    if stop.is_set():
+                        break
+                    put(item)
+            except BaseException as e:
+                put(e)
+            finally:
+                put(done)
+
+        loop.run_in_executor(self._executor, reader)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    async def _stream(self, model: GenerativeModel, contents, **kwargs):
+        """Стриминговый вызов модели: чанки ответа по мере их поступления"""
+        started = time.monotonic()
+        first = True
+        if hasattr(model, 'generate_content_async'):
+            response = await model.generate_content_async(contents, stream=True, **kwargs)
+            chunks = response.__aiter__()
+        else:
+            response = await self._run_blocking(model.generate_content, contents, stream=True, **kwargs)
+            chunks = self._iterate_in_thread(response)
+        async for chunk in chunks:
+            if first:
+                first = False
+                metrics.stage('gemini_first_token', time.monotonic() - started)
+            yield chunk
+
+    async def _stream_with_timeouts(self, model: GenerativeModel, contents, chunk_timeout: float,
+                                    total_timeout: float, **kwargs):
+        """Стрим с ограничением ожидания каждого чанка и всего ответа целиком"""
+        chunks = self._stream(model, contents, **kwargs).__aiter__()
+        deadline = time.monotonic() + total_timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise StreamTimeout(f"no complete response in {total_timeout:g}s")
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=min(chunk_timeout, remaining))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    if remaining <= chunk_timeout:
+                        raise StreamTimeout(f"no complete response in {total_timeout:g}s")
+                    raise StreamTimeout(f"no chunk in {chunk_timeout:g}s")
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        try:
+            return chunk.text or ''
+        except ValueError:
+            # В чанке нет текстовых частей (например, ответ заблокирован)
+            return ''
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        stats = dict(self.pool_stats)
+        stats['avg_wait'] = stats['total_wait'] / stats['requests'] if stats['requests'] else 0.0
+        stats['max_concurrency'] = self.max_concurrency
+        stats['models'] = len(self._models)
+        stats['model_cache'] = dict(self.model_cache_stats)
+        if self.context_cache is not None:
+            stats['context_cache'] = self.context_cache.get_stats()
+        return stats
+
+    def _request_key(self, kind: str, prompt: str, generation_config: Optional[GenConfig],
+                     system_instruction: Optional[str] = None) -> str:
+        return self.coalescer.make_key(
+            kind,
+            self.key_pool.primary.model_name,
+            self.system_instructions if system_instruction is None else system_instruction,
+            repr(getattr(generation_config, '__dict__', generation_config)),
+            prompt
         )
 
     async def generate_text_content(
             self,
             prompt: str,
             generation_config: Optional[GenConfig] = None,
-            max_retries: int = 3
+            max_retries: int = 3,
+            priority: int = PRIORITY_NORMAL,
+            system_instruction: Optional[str] = None
+    ) -> Dict[str, Any]:
+        key = self._request_key('text', prompt, generation_config, system_instruction)
+        return await self.coalescer.call(
+            key, lambda: self._generate_text_content(prompt, generation_config, max_retries, priority,
+                                                     system_instruction)
+        )
+
+    async def _generate_text_content(
+            self,
+            prompt: str,
+            generation_config: Optional[GenConfig] = None,
+            max_retries: int = 3,
+            priority: int = PRIORITY_NORMAL,
+            system_instruction: Optional[str] = None
     ) -> Dict[str, Any]:
         self.logger.info(f"Generating text content for prompt: {prompt}")
 
@@ -217,13 +2550,13 @@ class GeminiTester:
         for attempt in range(max_retries):
             try:
 
-                response = await asyncio.get_event_loop().run_in_executor(
-                    None,
-                    lambda: self.model.generate_content(
-                        prompt,
-                        generation_config=generation_config,
-                        safety_settings=self._get_safety_settings()
-                    )
+                response = await self._generate(
+                    prompt,
+                    priority=priority,
+                    tokens=estimate_tokens(prompt) + GEMINI_OUTPUT_TOKEN_ESTIMATE,
+                    system_instruction=system_instruction,
+                    generation_config=generation_config,
+                    safety_settings=self._get_safety_settings()
                 )
 
                 return {
@@ -234,12 +2567,107 @@ class GeminiTester:
 
             except Exception as e:
                 self.logger.error(f"Attempt {attempt + 1}/{max_retries} failed: {str(e)}")
-                if attempt == max_retries - 1:
+                if attempt == max_retries - 1 or isinstance(e, CircuitOpenError):
                     return {
                         'success': False,
-                        'error': str(e)
+                        'error': str(e),
+                        'circuit_open': isinstance(e, CircuitOpenError)
                     }
-                await asyncio.sleep(2 ** attempt)
+                metrics.inc('bot_gemini_retries_total', kind='text')
+                await QuotaScheduler.backoff(e, attempt)
+
+    async def stream_text_content(
+            self,
+            prompt: str,
+            generation_config: Optional[GenConfig] = None,
+            max_retries: int = 3,
+            priority: int = PRIORITY_NORMAL,
+            system_instruction: Optional[str] = None
+    ):
+        """
+        Потоковая генерация текста: асинхронно отдаёт куски ответа по мере генерации.
+
+        Повторные попытки возможны только до первого полученного куска; ошибка после
+        этого пробрасывается вызывающему коду, у которого уже есть частичный текст.
+        """
+        key = self._request_key('stream', prompt, generation_config, system_instruction)
+        async for chunk in self.coalescer.stream(
+                key, lambda: self._stream_text_content(prompt, generation_config, max_retries, priority,
+                                                       system_instruction)
+        ):
+            yield chunk
+
+    async def _stream_text_content(
+            self,
+            prompt: str,
+            generation_config: Optional[GenConfig] = None,
+            max_retries: int = 3,
+            priority: int = PRIORITY_NORMAL,
+            system_instruction: Optional[str] = None
+    ):
+        self.logger.info(f"Streaming text content for prompt: {prompt}")
+
+        for attempt in range(max_retries):
+            started = False
+            try:
+                tokens = estimate_tokens(prompt) + GEMINI_OUTPUT_TOKEN_ESTIMATE
+                async with self._model_slot(priority, tokens, system_instruction=system_instruction) as usage:
+                    async for chunk in self._stream(
+                            usage['model'],
+                            prompt,
+                            generation_config=generation_config,
+                            safety_settings=self._get_safety_settings()
+                    ):
+                        self._record_usage(usage, chunk)
+                        text = self._chunk_text(chunk)
+                        if text:
+                            started = True
+                            yield text
+                return
+            except Exception as e:
+                self.logger.error(f"Attempt {attempt + 1}/{max_retries} failed: {str(e)}")
+                if started or attempt == max_retries - 1 or isinstance(e, CircuitOpenError):
+                    raise
+                metrics.inc('bot_gemini_retries_total', kind='stream')
+                await QuotaScheduler.backoff(e, attempt)
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _file_part(entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Часть запроса по записи кеша изображений: встроенные байты или ссылка на файл"""
+        if 'data' in entry:
+            return {'mime_type': entry['mime_type'], 'data': entry['data']}
+        return {'file_data': {'mime_type': entry['mime_type'], 'file_uri': entry['uri']}}
+
+    async def _image_part(self, image_data: bytes, mime_type: str, image_id: Optional[str] = None):
+        """Часть запроса с изображением: встроенные байты или файл, загруженный из буфера"""
+        if self.image_cache is None:
+            if len(image_data) <= INLINE_IMAGE_LIMIT:
+                return {'mime_type': mime_type, 'data': image_data}
+            return await self._run_blocking(upload_file, io.BytesIO(image_data), mime_type=mime_type)
+
+        keys = [self.image_cache.content_key(image_data)]
+        if image_id:
+            keys.append(self.image_cache.telegram_key(image_id))
+
+        if len(image_data) <= INLINE_IMAGE_LIMIT:
+            # Встроенные байты не требуют загрузки; запоминаем их, чтобы повтор не скачивать из Telegram
+            self.image_cache.put_inline(keys, image_data, mime_type)
+            return {'mime_type': mime_type, 'data': image_data}
+
+        entry = self.image_cache.get(*keys)
+        if entry is None:
+            uploaded_file = await self._run_blocking(upload_file, io.BytesIO(image_data), mime_type=mime_type)
+            self.image_cache.put(keys, uploaded_file, mime_type)
+            return uploaded_file
+
+        # Та же картинка под новым file_unique_id: запоминаем и его
+        self.image_cache.alias(keys, entry)
+        return self._file_part(entry)
 
     def _get_safety_settings(self) -> Dict[HarmCategory, HarmBlockThreshold]:
         return {
@@ -252,39 +2680,62 @@ class GeminiTester:
     async def generate_image_content_stream(
             self,
             prompt: str,
-            image_path: str,
+            image_path: Optional[str] = None,
             generation_config: Optional[GenConfig] = None,
-            max_retries: int = 3
+            max_retries: int = 3,
+            chunk_timeout: float = 30.0,
+            total_timeout: float = 60.0,
+            image_data: Optional[bytes] = None,
+            mime_type: str = 'image/jpeg',
+            image_file: Optional[Dict[str, Any]] = None,
+            image_id: Optional[str] = None,
+            priority: int = PRIORITY_NORMAL,
+            system_instruction: Optional[str] = None
     ) -> Dict[str, Any]:
+        """
+        Ответ на изображение. Картинка передаётся байтами (image_data) и уходит в запрос
+        встроенной частью; большие изображения загружаются через File API прямо из памяти.
+        image_path оставлен для вызовов с файлом на диске.
+
+        Если включён кеш изображений, картинки крупнее INLINE_IMAGE_LIMIT загружаются через File API
+        один раз и дальше запрос ссылается на загруженный файл, а мелкие запоминаются байтами:
+        image_file — уже найденная в кеше запись, image_id — file_unique_id из Telegram для новой записи. Если файла на сервере уже нет,
+        запись сбрасывается и в ответе стоит file_missing — вызывающий загружает картинку заново.
+
+        system_instruction — системные инструкции чата (None — инструкции по умолчанию).
+        """
         try:
-            base_config = GenConfig(
-                candidate_count=1,
-                max_output_tokens=1000,
-                temperature=1.0,
-                top_p=1.0,
-                top_k=40
-            )
+            base_config = self._base_config()
 
-            # Добавляем проверку существования файла
-            if not os.path.exists(image_path):
-                return {
-                    'success': False,
-                    'error': 'Image file not found'
-                }
+            if image_data is None and image_file is None:
+                # Добавляем проверку существования файла
+                if not image_path or not os.path.exists(image_path):
+                    return {
+                        'success': False,
+                        'error': 'Image file not found'
+                    }
+                try:
+                    image_data = await asyncio.to_thread(self._read_file, image_path)
+                except Exception as e:
+                    self.logger.error(f"Error reading image file: {e}")
+                    return {
+                        'success': False,
+                        'error': f"Error reading image file: {str(e)}"
+                    }
 
-            # Читаем файл в память перед загрузкой
             try:
-                with open(image_path, 'rb') as f:
-                    image_data = f.read()
-                uploaded_file = upload_file(image_path)
+                if image_file is not None:
+                    image_part = self._file_part(image_file)
+                else:
+                    image_part = await self._image_part(image_data, mime_type, image_id)
             except Exception as e:
-                self.logger.error(f"Error reading image file: {e}")
+                self.logger.error(f"Error uploading image: {e}")
                 return {
                     'success': False,
-                    'error': f"Error reading image file: {str(e)}"
+                    'error': f"Error uploading image: {str(e)}"
                 }
 
-            content = [prompt, uploaded_file]
+            content = [prompt, image_part]
 
             request_params = {
                 'prompt': prompt,
@@ -294,103 +2745,92 @@ class GeminiTester:
             }
 
             for attempt in range(max_retries):
-                try:
-                    self.logger.info(f"Attempt {attempt + 1}/{max_retries}")
+                self.logger.info(f"Attempt {attempt + 1}/{max_retries}")
+
+                accumulated_text = []
+                finish_reason = None
+                block_reason = None
+                last_error = None
+                last_chunk = None
 
-                    # Увеличиваем таймаут для запроса
-                    response = await asyncio.wait_for(
-                        asyncio.get_event_loop().run_in_executor(
-                            None,
-                            lambda: self.model.generate_content(
+                try:
+                    # ~258 токенов на изображение
+                    tokens = estimate_tokens(prompt) + 258 + GEMINI_OUTPUT_TOKEN_ESTIMATE
+                    # Загруженные файлы доступны только ключу, через который их загружали
+                    inline = isinstance(image_part, dict) and 'data' in image_part
+                    key = None if inline else self.key_pool.primary
+                    async with self._model_slot(priority, tokens, key, system_instruction) as usage:
+                        async for chunk in self._stream_with_timeouts(
+                                usage['model'],
                                 content,
-                                stream=True,
+                                chunk_timeout=chunk_timeout,
+                                total_timeout=total_timeout,
                                 generation_config=base_config,
                                 safety_settings=self._get_safety_settings()
-                            )
-                        ),
-                        timeout=30.0  # 30 секунд таймаут
-                    )
-
-                    accumulated_text = []
-                    finish_reason = None
-                    block_reason = None
-                    last_error = None
-
-                    try:
-                        async def process_stream():
-                            for chunk in response:
-                                if chunk.text:
-                                    accumulated_text.append(chunk.text)
-                                    self.logger.debug(f"Captured chunk: {chunk.text}")
-
-                                if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
-                                    nonlocal block_reason
-                                    block_reason = chunk.prompt_feedback.block_reason
-                                    self.logger.warning(f"Block detected: {block_reason}")
-
-                                if chunk.candidates and chunk.candidates[0].finish_reason:
-                                    nonlocal finish_reason
-                                    finish_reason = chunk.candidates[0].finish_reason
-                                    self.logger.warning(f"Finish reason: {finish_reason}")
-
-                        # Добавляем таймаут для обработки стрима
-                        await asyncio.wait_for(process_stream(), timeout=30.0)
-
-                    except asyncio.TimeoutError:
-                        self.logger.error("Stream processing timeout")
-                        last_error = "Stream processing timeout"
-                    except Exception as e:
-                        last_error = e
-                        self.logger.error(f"Stream processing error: {str(e)}")
-
-                    full_text = ''.join(accumulated_text)
-
-                    result = {
-                        'success': True if full_text else False,
-                        'text': full_text,
-                        'response_object': response,
-                        'request_params': request_params,
-                        'metadata': {
-                            'finish_reason': finish_reason,
-                            'block_reason': block_reason,
-                            'was_blocked': bool(block_reason or finish_reason in [3, 7, 8, 9]),
-                            'partial_generation': bool(accumulated_text and (block_reason or last_error)),
-                            'error': str(last_error) if last_error else None
-                        }
+                        ):
+                            last_chunk = chunk
+                            self._record_usage(usage, chunk)
+                            text = self._chunk_text(chunk)
+                            if text:
+                                accumulated_text.append(text)
+                                self.logger.debug(f"Captured chunk: {text}")
+
+                            if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                                block_reason = chunk.prompt_feedback.block_reason
+                                self.logger.warning(f"Block detected: {block_reason}")
+
+                            if chunk.candidates and chunk.candidates[0].finish_reason:
+                                finish_reason = chunk.candidates[0].finish_reason
+                                self.logger.warning(f"Finish reason: {finish_reason}")
+
+                except StreamTimeout as e:
+                    self.logger.error(f"Stream processing timeout: {e}")
+                    last_error = e
+                except Exception as e:
+                    last_error = e
+                    self.logger.error(f"Stream processing error: {str(e)}")
+
+                full_text = ''.join(accumulated_text)
+
+                result = {
+                    'success': True if full_text else False,
+                    'text': full_text,
+                    'response_object': last_chunk,
+                    'request_params': request_params,
+                    'metadata': {
+                        'finish_reason': finish_reason,
+                        'block_reason': block_reason,
+                        'was_blocked': bool(block_reason or finish_reason in [3, 7, 8, 9]),
+                        'partial_generation': bool(accumulated_text and (block_reason or last_error)),
+                        'timed_out': isinstance(last_error, StreamTimeout),
+                        'error': str(last_error) if last_error else None
                     }
+                }
 
-                    if accumulated_text:
-                        self.logger.info(f"Captured text: {len(full_text)} chars")
-                        return result
-
-                    if last_error and attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)
-                        continue
+                if result['metadata']['was_blocked']:
+                    metrics.inc('bot_gemini_blocked_total')
 
+                if accumulated_text:
+                    self.logger.info(f"Captured text: {len(full_text)} chars")
                     return result
 
-                except asyncio.TimeoutError:
-                    self.logger.error(f"Request timeout on attempt {attempt + 1}")
-                    if attempt == max_retries - 1:
-                        return {
-                            'success': False,
-                            'error': 'Request timeout',
-                            'text': ''.join(accumulated_text) if 'accumulated_text' in locals() else '',
-                            'request_params': request_params,
-                            'metadata': {'was_blocked': True}
-                        }
-                    await asyncio.sleep(2 ** attempt)
-                except Exception as e:
-                    self.logger.error(f"Error on attempt {attempt + 1}: {e}")
-                    if attempt == max_retries - 1:
-                        return {
-                            'success': False,
-                            'error': str(e),
-                            'text': ''.join(accumulated_text) if 'accumulated_text' in locals() else '',
-                            'request_params': request_params,
-                            'metadata': {'was_blocked': True}
-                        }
-                    await asyncio.sleep(2 ** attempt)
+                file_uri = image_part.get('file_data', {}).get('file_uri') if isinstance(image_part, dict) \
+                    else getattr(image_part, 'uri', None)
+                if isinstance(last_error, CircuitOpenError):
+                    result['circuit_open'] = True
+                elif last_error and file_uri and is_file_missing_error(last_error):
+                    # Повтор с той же ссылкой бесполезен: сбрасываем запись кеша, вызывающий загрузит заново
+                    if self.image_cache is not None:
+                        self.image_cache.invalidate_uri(file_uri)
+                    result['file_missing'] = True
+                elif last_error and attempt < max_retries - 1:
+                    metrics.inc('bot_gemini_retries_total', kind='image')
+                    await QuotaScheduler.backoff(last_error, attempt)
+                    continue
+
+                if last_error:
+                    result['error'] = str(last_error)
+                return result
 
         except Exception as e:
             self.logger.error(f"Fatal error: {str(e)}")
@@ -404,14 +2844,515 @@ class GeminiTester:
 gemini_tester = GeminiTester
 
 DEFAULT_TRIGGERS = {'сосаня', 'александр', '@Chuvashini_bot', 'чуваш', 'саня', 'сань'}
-chat_triggers = {}
+chat_settings = ChatSettingsStore()
+
+# Имя бота запрашивается один раз при запуске (см. check_telegram_bot)
+bot_username: Optional[str] = None
+
+
+class TriggerMatcher:
+    """
+    Набор триггеров чата (вместе с упоминанием бота), скомпилированный в одно регулярное выражение.
+
+    Поиск обращения — один проход по тексту без учёта регистра; очистка удаляет триггеры,
+    стоящие отдельными словами, сохраняя регистр остального текста.
+    """
+
+    def __init__(self, triggers, bot_mention: Optional[str] = None):
+        words = {t.lower() for t in triggers if t}
+        if bot_mention:
+            words.add(bot_mention.lower())
+        # Длинные триггеры раньше коротких, чтобы 'сосаня' не срезалось до 'со' + 'саня'
+        alternatives = '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+        self._search = re.compile(alternatives, re.IGNORECASE) if words else None
+        self._words = re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)', re.IGNORECASE) if words else None
+        # Вместе с триггером срезаем и знак после него: "Саня, привет" -> "привет"
+        self._strip = re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)[,.!?:]?', re.IGNORECASE) if words else None
+
+    def matches(self, text: str) -> bool:
+        return bool(self._search and self._search.search(text))
+
+    def strip(self, text: str) -> str:
+        if not self._strip:
+            return text.strip()
+        cleaned = ' '.join(self._strip.sub(' ', text).split())
+        if not cleaned and self._words.sub('', text).strip():
+            # Кроме триггера только знак препинания ("Саня?") — отвечаем на исходный текст, как раньше
+            return ' '.join(text.split())
+        return cleaned
+
+
+_trigger_matchers: Dict[str, TriggerMatcher] = {}
+
+
+def get_chat_triggers(chat_id: str) -> Optional[set]:
+    """Собственные триггеры чата или None, если чат использует DEFAULT_TRIGGERS"""
+    triggers = chat_settings.get(chat_id, 'triggers')
+    return set(triggers) if triggers is not None else None
+
+
+def set_chat_triggers(chat_id: str, triggers: set):
+    chat_settings.set(chat_id, 'triggers', sorted(triggers))
+    invalidate_trigger_matcher(chat_id)
+
+
+def get_trigger_matcher(chat_id: str) -> TriggerMatcher:
+    """Скомпилированный матчер триггеров чата (пересобирается только после изменения триггеров)"""
+    matcher = _trigger_matchers.get(chat_id)
+    if matcher is None:
+        bot_mention = f"@{bot_username}" if bot_username else None
+        triggers = get_chat_triggers(chat_id)
+        if triggers is not None:
+            matcher = TriggerMatcher(triggers, bot_mention)
+        else:
+            # Чаты без своих триггеров используют один общий матчер
+            matcher = _trigger_matchers.get(None) or TriggerMatcher(DEFAULT_TRIGGERS, bot_mention)
+            _trigger_matchers[None] = matcher
+        _trigger_matchers[chat_id] = matcher
+    return matcher
+
+
+def invalidate_trigger_matcher(chat_id: Optional[str] = None):
+    """Сброс скомпилированных матчеров чата (или всех, если chat_id не указан)"""
+    if chat_id is None:
+        _trigger_matchers.clear()
+    else:
+        _trigger_matchers.pop(chat_id, None)
+
+
+async def resolve_bot_username(bot) -> Optional[str]:
+    """Имя бота из кеша; сетевой запрос get_me выполняется только если при запуске он не удался"""
+    global bot_username
+    if bot_username is None:
+        with metrics.timer('get_me'):
+            bot_username = (await bot.get_me()).username
+        invalidate_trigger_matcher()
+    return bot_username
+
+
+def is_reply_to(message, bot_id) -> bool:
+    return bool(
+        message.reply_to_message and
+        message.reply_to_message.from_user and
+        message.reply_to_message.from_user.id == bot_id
+    )
+
+
+def chat_system_instruction(chat_id: str, default_style: str = DEFAULT_STYLE_PROMPT) -> str:
+    """
+    Системные инструкции чата: свои (/set_instructions) или общие, плюс стиль (/style).
+    Стиль передаётся моделью, а не повторяется в тексте каждого запроса.
+    """
+    instructions = chat_settings.get(chat_id, 'system_instructions') or gemini_tester.system_instructions
+    style = chat_settings.get(chat_id, 'style_prompt', default_style)
+    return f"{instructions.rstrip()}\n{style}"
+
+
+class ContextBuilder:
+    """
+    Сборка истории чата для промпта в пределах бюджета токенов.
+
+    Последние сообщения берутся целиком, от новых к старым, пока помещаются в бюджет;
+    всё, что старше, представлено кратким пересказом. Пересказ хранится для каждого чата
+    и обновляется в фоне только после того, как за пределами окна накопилось
+    refresh_every ещё не пересказанных сообщений.
+    """
+
+    def __init__(self, summarize, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 refresh_every: int = SUMMARY_REFRESH_MESSAGES, max_chats: int = 1000):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.refresh_every = refresh_every
+        self.max_chats = max_chats
+        # chat_id -> {'text': пересказ, 'covered_until': timestamp последнего пересказанного сообщения}
+        self._summaries: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._refreshing: set = set()
+
+    @staticmethod
+    def format_message(msg: Dict[str, Any], matcher: TriggerMatcher) -> str:
+        if msg['is_bot']:
+            return f"Ты написал:\n{msg['text']}"
+        # Очищаем сообщение пользователя от обращений к боту
+        return f"{msg.get('username') or 'Неизвестный'} написал:\n{matcher.strip(msg['text'])}"
+
+    def build(self, chat_id: str, history: List[Dict[str, Any]], matcher: TriggerMatcher,
+              reserved_tokens: int = 0) -> List[str]:
+        """Части промпта с историей: пересказ (если есть) и последние сообщения"""
+        summary = self._summaries.get(chat_id)
+        if summary:
+            self._summaries.move_to_end(chat_id)
+        covered_until = summary['covered_until'] if summary else ''
+
+        budget = self.token_budget - reserved_tokens
+        if summary:
+            budget -= estimate_tokens(summary['text'])
+
+        window: List[str] = []
+        start = len(history)
+        for msg in reversed(history):
+            # Дальше — сообщения, которые уже есть в пересказе
+            if covered_until and msg['timestamp'] <= covered_until:
+                break
+            text = self.format_message(msg, matcher)
+            cost = estimate_tokens(text)
+            if cost > budget:
+                break
+            budget -= cost
+            window.append(text)
+            start -= 1
+        window.reverse()
+
+        overflow = [msg for msg in history[:start] if not covered_until or msg['timestamp'] > covered_until]
+        if len(overflow) >= self.refresh_every and chat_id not in self._refreshing:
+            self._refreshing.add(chat_id)
+            asyncio.ensure_future(self._refresh(chat_id, summary, overflow, matcher))
+
+        parts = []
+        if summary:
+            parts.append(f"Краткое содержание более ранней переписки:\n{summary['text']}")
+        if window:
+            parts.append("\n".join(window))
+        return parts
+
+    async def _refresh(self, chat_id: str, previous: Optional[Dict[str, str]], overflow: List[Dict[str, Any]],
+                       matcher: TriggerMatcher):
+        """Дополнение пересказа сообщениями, выпавшими из окна"""
+        try:
+            prompt_parts = ["Кратко (не более 600 символов), нейтрально и без оценок перескажи переписку: "
+                            "кто что говорил, о чём договорились, какие темы обсуждали."]
+            if previous:
+                prompt_parts.append(f"Пересказ более ранней части:\n{previous['text']}")
+            prompt_parts.append("Сообщения:\n" + "\n".join(self.format_message(m, matcher) for m in overflow))
+
+            response = await self.summarize("\n\n".join(prompt_parts))
+            if response.get('success') and response.get('text'):
+                self._summaries[chat_id] = {
+                    'text': response['text'].strip(),
+                    'covered_until': overflow[-1]['timestamp'],
+                }
+                self._summaries.move_to_end(chat_id)
+                while len(self._summaries) > self.max_chats:
+                    self._summaries.popitem(last=False)
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении пересказа истории: {e}")
+        finally:
+            self._refreshing.discard(chat_id)
+
+    def reset(self, chat_id: str):
+        self._summaries.pop(chat_id, None)
+
+
+def get_context_builder(context: CallbackContext) -> ContextBuilder:
+    if 'context_builder' not in context.bot_data:
+        context.bot_data['context_builder'] = ContextBuilder(
+            lambda prompt: gemini_tester.generate_text_content(prompt, max_retries=1, priority=PRIORITY_LOW)
+        )
+    return context.bot_data['context_builder']
+
+
+class BurstBatch:
+    """Пачка сообщений чата, на которую бот отвечает одним сообщением"""
+
+    def __init__(self, items: List[Dict[str, Any]], previous: Optional[asyncio.Future] = None):
+        self.items = items
+        # Ответ предыдущей пачки, который нужно дождаться; отмена этой пачки его не отменяет
+        self.previous = previous
+        # Ответ начали отправлять — после этого пачку уже нельзя отменить и переобъединить
+        self.committed = False
+
+    def commit(self):
+        self.committed = True
+
+
+class ChatDebouncer:
+    """
+    Объединение сообщений, отправленных боту подряд, в один запрос к модели.
+
+    После каждого обращения ждём window секунд; если за это время в чат пришло ещё
+    обращение, окно начинается заново. Если ответ на предыдущую пачку ещё не начали
+    отправлять, он отменяется и его сообщения попадают в новую пачку. Пачки одного чата
+    обрабатываются строго по очереди, разные чаты — параллельно.
+    """
+
+    def __init__(self, process, window: float = DEBOUNCE_WINDOW):
+        self.process = process
+        self.window = window
+        self._chats: Dict[str, Dict[str, Any]] = {}
+        self.stats = {'messages': 0, 'batches': 0, 'superseded': 0}
+
+    def submit(self, chat_id: str, item: Dict[str, Any]):
+        self.stats['messages'] += 1
+        state = self._chats.setdefault(chat_id, {'pending': [], 'timer': None, 'active': None, 'batch': None,
+                                                 'previous': None})
+        state['pending'].append(item)
+
+        active = state['active']
+        if active is not None and not active.done() and not state['batch'].committed:
+            active.cancel()
+            state['pending'] = state['batch'].items + state['pending']
+            state['active'] = None
+            # Отменённая пачка могла ждать уже отправляемого ответа — новая пачка ждёт его же
+            state['previous'] = state['batch'].previous
+            self.stats['superseded'] += 1
+
+        if state['timer'] is not None:
+            state['timer'].cancel()
+        state['timer'] = asyncio.ensure_future(self._dispatch_later(chat_id, state))
+
+    async def _dispatch_later(self, chat_id: str, state: Dict[str, Any]):
+        await asyncio.sleep(self.window)
+        state['timer'] = None
+        self._dispatch(chat_id, state)
+
+    def _dispatch(self, chat_id: str, state: Dict[str, Any]):
+        previous = state['active'] if state['active'] is not None else state['previous']
+        batch = BurstBatch(state['pending'], previous)
+        state['pending'] = []
+        state['previous'] = None
+        state['batch'] = batch
+        state['active'] = asyncio.ensure_future(self._run(chat_id, state, batch, previous))
+
+    async def _run(self, chat_id: str, state: Dict[str, Any], batch: BurstBatch, previous):
+        try:
+            if previous is not None and not previous.done():
+                # Сначала дожидаемся уже отправляемого ответа, чтобы ответы не перепутались
+                await asyncio.wait({previous})
+            self.stats['batches'] += 1
+            await self.process(chat_id, batch.items, batch)
+        except Exception as e:
+            logging.error(f"Ошибка при ответе на пачку сообщений: {e}")
+        finally:
+            if state['active'] is asyncio.current_task():
+                state['active'] = None
+            if state['active'] is None and state['timer'] is None and not state['pending']:
+                self._chats.pop(chat_id, None)
+
+    async def close(self):
+        """Остановка: пачки, ждущие окончания окна, отправляются сразу; дожидаемся всех ответов"""
+        while self._chats:
+            tasks = []
+            for chat_id, state in list(self._chats.items()):
+                if state['timer'] is not None:
+                    state['timer'].cancel()
+                    state['timer'] = None
+                    self._dispatch(chat_id, state)
+                if state['active'] is not None:
+                    tasks.append(state['active'])
+            if not tasks:
+                break
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_chat_debouncer(context: CallbackContext) -> ChatDebouncer:
+    if 'debouncer' not in context.bot_data:
+        context.bot_data['debouncer'] = ChatDebouncer(reply_to_messages)
+    return context.bot_data['debouncer']
+
+
+# Короткий ответ вместо запроса к модели, пока Gemini недоступен
+CIRCUIT_OPEN_REPLY = "🛠 Нейросеть сейчас недоступна, попробуйте через минуту."
+
+
+_MDV2_SPECIAL = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\])')
+_MD_CODE_BLOCK = re.compile(r'```(?:([\w+-]+)\n|\n?)(.*?)```', re.DOTALL)
+_MD_INLINE = re.compile(
+    r'`([^`\n]+)`'                                        # код
+    r'|\[([^\]\n]+)\]\(([^()\s]+)\)'                      # ссылка
+    r'|\*\*(.+?)\*\*'                                     # жирный
+    r'|__(.+?)__'                                          # жирный (вариант)
+    r'|~~(.+?)~~'                                          # зачёркнутый
+    r'|(?<![\w*])\*(?![\s*])(.+?)(?<![\s*])\*(?![\w*])'   # курсив *...*
+    r'|(?<![\w_])_(?![\s_])(.+?)(?<![\s_])_(?![\w_])'       # курсив _..._
+)
+_MD_HEADING = re.compile(r'^\s{0,3}#{1,6}\s+(.+?)\s*#*\s*$')
+_MD_BULLET = re.compile(r'^(\s*)[*+-]\s+')
+
+def escape_markdown_v2(text: str) -> str:
+    return _MDV2_SPECIAL.sub(r'\\\1', text)
+
+
+def _markdown_inline(text: str, in_bold: bool = False) -> str:
+    """
+    Строчная разметка Markdown -> MarkdownV2; всё непарное экранируется как обычный текст.
+    in_bold — текст уже внутри жирного: вложенный жирный (**x**, __x__) раскрывается без маркеров.
+    """
+    result = []
+    position = 0
+    for match in _MD_INLINE.finditer(text):
+        result.append(escape_markdown_v2(text[position:match.start()]))
+        code, link_text, url, bold, bold_alt, strike, italic, italic_alt = match.groups()
+        if code is not None:
+            result.append('`' + code.replace('\\', '\\\\').replace('`', '\\`') + '`')
+        elif link_text is not None:
+            url = url.replace('\\', '\\\\')
+            result.append(f"[{escape_markdown_v2(link_text)}]({url})")
+        elif bold is not None or bold_alt is not None:
+            # Вложенный жирный в MarkdownV2 недопустим
+            inner = _markdown_inline((bold if bold is not None else bold_alt).replace('**', ''), in_bold=True)
+            result.append(inner if in_bold else f"*{inner}*")
+        elif strike is not None:
+            result.append(f"~{_markdown_inline(strike, in_bold)}~")
+        else:
+            inner = italic if italic is not None else italic_alt
+            result.append(f"_{escape_markdown_v2(inner)}_")
+        position = match.end()
+    result.append(escape_markdown_v2(text[position:]))
+    return ''.join(result)
+
+
+def _markdown_lines(text: str) -> str:
+    lines = []
+    for line in text.split('\n'):
+        heading = _MD_HEADING.match(line)
+        if heading:
+            # Заголовков в Telegram нет — делаем строку жирной
+            lines.append(f"*{_markdown_inline(heading.group(1), in_bold=True)}*")
+            continue
+        bullet = _MD_BULLET.match(line)
+        if bullet:
+            line = f"{bullet.group(1)}• {line[bullet.end():]}"
+        lines.append(_markdown_inline(line))
+    return '\n'.join(lines)
+
+
+def markdown_to_telegram(text: str) -> str:
+    """
+    Перевод Markdown из ответа Gemini в корректный MarkdownV2 Telegram.
+
+    Поддерживаются блоки и строки кода, ссылки, жирный, курсив, зачёркнутый, заголовки
+    и списки; непарные и незнакомые символы разметки экранируются, поэтому результат
+    всегда принимается Telegram с первой попытки.
+    """
+    result = []
+    position = 0
+    for match in _MD_CODE_BLOCK.finditer(text):
+        result.append(_markdown_lines(text[position:match.start()]))
+        language, code = match.groups()
+        code = code.replace('\\', '\\\\').replace('`', '\\`')
+        result.append(f"```{language or ''}\n{code}```")
+        position = match.end()
+    result.append(_markdown_lines(text[position:]))
+    return ''.join(result)
+
+
+async def send_formatted_reply(context: CallbackContext, chat_id, text: str, reply_to_message_id: int):
+    """Отправка ответа с разметкой одним запросом; простой текст — только при неожиданной ошибке"""
+    try:
+        with metrics.timer('telegram_send'):
+            message = await context.bot.send_message(
+                chat_id=chat_id,
+                text=markdown_to_telegram(text),
+                parse_mode='MarkdownV2',
+                reply_to_message_id=reply_to_message_id
+            )
+        metrics.inc('bot_markdown_replies_total', outcome='formatted')
+        return message
+    except BadRequest as format_error:
+        metrics.inc('bot_markdown_replies_total', outcome='fallback')
+        logging.error(f"Ошибка форматирования MarkdownV2: {format_error}")
+        with metrics.timer('telegram_send'):
+            return await context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_to_message_id=reply_to_message_id
+            )
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+async def _edit_final(context: CallbackContext, attempts: int = 3, **kwargs):
+    """Правка, которую нельзя пропустить: при RetryAfter ждём указанное время и повторяем"""
+    for attempt in range(attempts):
+        try:
+            with metrics.timer('telegram_edit'):
+                return await context.bot.edit_message_text(**kwargs)
+        except RetryAfter as e:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(_retry_after_seconds(e))
+
+
+async def edit_formatted_reply(context: CallbackContext, chat_id, message_id: int, text: str, shown: str):
+    """Финальная правка потокового ответа с разметкой; shown — текст, который уже виден в чате"""
+    try:
+        await _edit_final(context, chat_id=chat_id, message_id=message_id,
+                          text=markdown_to_telegram(text), parse_mode='MarkdownV2')
+        metrics.inc('bot_markdown_replies_total', outcome='formatted')
+        return
+    except BadRequest as format_error:
+        if 'not modified' in str(format_error).lower():
+            # Разметки в ответе нет и текст уже показан целиком
+            return
+        metrics.inc('bot_markdown_replies_total', outcome='fallback')
+        logging.error(f"Ошибка форматирования MarkdownV2: {format_error}")
+
+    if text != shown:
+        await _edit_final(context, chat_id=chat_id, message_id=message_id, text=text)
+
+
+async def send_streaming_reply(context: CallbackContext, chat_id, reply_to_message_id: int, chunks,
+                               on_start=None) -> Dict[str, Any]:
+    """
+    Отправка ответа по мере генерации.
+
+    Первое сообщение уходит сразу с первым куском текста, дальнейшие куски копятся и
+    показываются правками не чаще STREAM_EDIT_INTERVAL; в конце текст правится с разметкой.
+    on_start вызывается прямо перед отправкой первого сообщения.
+    """
+    text = ''
+    shown = ''
+    sent = None
+    next_edit = 0.0
+    error = None
 
+    try:
+        async for piece in chunks:
+            text += piece
+            now = time.monotonic()
+            if sent is None:
+                if on_start:
+                    on_start()
+                with metrics.timer('telegram_send'):
+                    sent = await context.bot.send_message(chat_id=chat_id, text=text,
+                                                          reply_to_message_id=reply_to_message_id)
+                shown = text
+                next_edit = now + STREAM_EDIT_INTERVAL
+            elif now >= next_edit and text != shown:
+                next_edit = now + STREAM_EDIT_INTERVAL
+                try:
+                    with metrics.timer('telegram_edit'):
+                        await context.bot.edit_message_text(chat_id=chat_id, message_id=sent.message_id, text=text)
+                    shown = text
+                except RetryAfter as e:
+                    next_edit = now + _retry_after_seconds(e)
+                except BadRequest as e:
+                    logging.debug(f"Промежуточная правка не удалась: {e}")
+    except Exception as e:
+        logging.error(f"Ошибка при потоковой генерации: {e}")
+        error = str(e)
+
+    if sent is None:
+        return {'success': False, 'text': text, 'error': error or 'Пустой ответ', 'sent': False}
+
+    try:
+        await edit_formatted_reply(context, chat_id, sent.message_id, text, shown)
+    except Exception as e:
+        logging.error(f"Ошибка финальной правки ответа: {e}")
+        error = error or str(e)
+
+    return {'success': True, 'text': text, 'error': error, 'sent': True}
 
+
+@traced('text')
 async def handle_message(update: Update, context: CallbackContext):
     """Обработка текстовых сообщений"""
     if not update.effective_message or not update.effective_message.text:
         return
 
+    metrics.inc('bot_updates_total', kind='text')
     message = update.effective_message.text
     chat_id = str(update.effective_chat.id)
     user_id = str(update.effective_message.from_user.id)
@@ -424,34 +3365,19 @@ async def handle_message(update: Update, context: CallbackContext):
     cleaned_message = message
 
     try:
-        # Проверяем упоминание бота
-        bot_username = (await context.bot.get_me()).username
-        bot_mention = f"@{bot_username}"
-        triggers = chat_triggers.get(chat_id, DEFAULT_TRIGGERS)
-
-        # Проверяем различные условия для ответа
-        is_bot_mentioned = any(
-            word.lower() in message.lower() for word in triggers) or bot_mention.lower() in message.lower()
-
-        # Проверяем, является ли это ответом на сообщение бота
-        is_reply_to_bot = (
-                update.effective_message.reply_to_message and
-                update.effective_message.reply_to_message.from_user and
-                update.effective_message.reply_to_message.from_user.id == context.bot.id
-        )
+        await resolve_bot_username(context.bot)
+        with tracer.span('trigger_match'):
+            matcher = get_trigger_matcher(chat_id)
 
-        # Очищаем сообщение от триггеров и упоминаний бота
-        cleaned_message = message.lower()
-        for trigger in triggers:
-            cleaned_message = cleaned_message.replace(trigger.lower(), '').strip()
-        cleaned_message = cleaned_message.replace(bot_mention.lower(), '').strip()
+            # Проверяем различные условия для ответа
+            is_bot_mentioned = matcher.matches(message)
 
-        # Восстанавливаем оригинальный регистр после очистки
-        if cleaned_message:
-            original_message_words = message.split()
-            cleaned_message = ' '.join(word for word in original_message_words
-                                       if word.lower() not in [t.lower() for t in triggers]
-                                       and word.lower() != bot_mention.lower())
+            # Проверяем, является ли это ответом на сообщение бота
+            is_reply_to_bot = is_reply_to(update.effective_message, context.bot.id)
+
+            # Очищаем сообщение от триггеров и упоминаний бота
+            if chat_type == 'private' or is_bot_mentioned or is_reply_to_bot:
+                cleaned_message = matcher.strip(message)
 
     except Exception as e:
         logging.error(f"Ошибка при обработке упоминаний: {e}")
@@ -464,59 +3390,143 @@ async def handle_message(update: Update, context: CallbackContext):
             is_reply_to_bot
     )
 
+    tracer.annotate(respond=bool(should_respond and cleaned_message))
     if not should_respond or not cleaned_message:
         return
 
-    # Сохраняем сообщение в историю и получаем контекст
+    # Сохраняем сообщение в историю
+    stored = None
     try:
-        context.bot_data.setdefault('history_manager', ChatHistoryManager())
+        # setdefault вычислял бы ChatHistoryManager() на каждое сообщение
+        if 'history_manager' not in context.bot_data:
+            context.bot_data['history_manager'] = ChatHistoryManager(backend=create_history_backend())
         history_manager = context.bot_data['history_manager']
 
         # Сохраняем сообщение пользователя
-        history_manager.add_message(
-            chat_id=chat_id,
-            user_id=user_id,
-            message=message,
-            username=username,
-            is_bot=False
+        with tracer.span('history_add'):
+            stored = history_manager.add_message(
+                chat_id=chat_id,
+                user_id=user_id,
+                message=message,
+                username=username,
+                is_bot=False
+            )
+    except Exception as e:
+        logging.error(f"Ошибка при работе с историей: {e}")
+
+    # Трассу завершит ответ на пачку, в которую попадёт сообщение
+    trace = current_trace.get()
+    if trace is not None:
+        trace.detached = True
+
+    # Отвечаем не сразу: следующие сообщения того же чата попадут в тот же ответ
+    get_chat_debouncer(context).submit(chat_id, {
+        'text': cleaned_message,
+        'username': username,
+        'priority': PRIORITY_HIGH if chat_type == 'private' or is_reply_to_bot else PRIORITY_NORMAL,
+        'message_id': update.effective_message.message_id,
+        'stored': stored,
+        'update': update,
+        'context': context,
+        'received': time.monotonic(),
+        'trace': trace,
+    })
+
+
+async def reply_to_messages(chat_id: str, items: List[Dict[str, Any]], batch: BurstBatch):
+    """Ответ на пачку с трассировкой: трассы сообщений пачки завершаются вместе с ответом"""
+    traces = [item['trace'] for item in items if item.get('trace') is not None]
+    # Этапы ответа пишутся в трассу последнего сообщения, остальные ссылаются на неё
+    trace = traces[-1] if traces else None
+    outcome = 'error'
+    try:
+        with tracer.activate(trace):
+            await _reply_to_messages(chat_id, items, batch)
+        outcome = 'replied'
+    except asyncio.CancelledError:
+        # Пачку переобъединили: её сообщения вместе с трассами перейдут в следующую
+        outcome = None
+        if trace is not None:
+            trace.attrs['superseded'] = trace.attrs.get('superseded', 0) + 1
+        raise
+    finally:
+        if outcome is not None:
+            for item_trace in traces:
+                tracer.finish(item_trace, outcome=outcome, batch_size=len(items), reply_trace=trace.trace_id)
+
+
+async def _reply_to_messages(chat_id: str, items: List[Dict[str, Any]], batch: BurstBatch):
+    """Один ответ на пачку сообщений, пришедших в чат подряд"""
+    last = items[-1]
+    update, context = last['update'], last['context']
+    username = last['username']
+    reply_to_message_id = last['message_id']
+    priority = min(item['priority'] for item in items)
+    history_manager = context.bot_data['history_manager']
+    matcher = get_trigger_matcher(chat_id)
+
+    if gemini_tester.breaker.is_open():
+        # Gemini недоступен — отвечаем сразу, не собирая промпт и не занимая очередь
+        batch.commit()
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=CIRCUIT_OPEN_REPLY,
+            reply_to_message_id=reply_to_message_id
         )
+        return
 
-        # Получаем историю чата
-        chat_history = history_manager.get_chat_history(chat_id)
+    # Сообщения пачки уже есть в истории, но попадут в промпт отдельно — из контекста их убираем.
+    # Они не обязательно последние: после них мог сохраниться ответ бота на предыдущую пачку
+    try:
+        with tracer.span('history'):
+            chat_history = history_manager.get_chat_history(
+                chat_id,
+                limit=history_manager.max_messages_per_chat,
+                exclude=[item['stored'] for item in items if item['stored']]
+            )
     except Exception as e:
         logging.error(f"Ошибка при работе с историей: {e}")
         chat_history = []
 
-    style_prompt = context.chat_data.get('style_prompt',
-                                         """Отвечай блять, как двачер(не более 1000 символов)...""")
+    system_instruction = chat_system_instruction(chat_id)
+    prompt_started = time.monotonic()
 
     try:
-        # Формируем контекст с учетом истории
-        context_messages = []
-        context_messages.append(f"Диалог с пользователем {username}")
-
-        # Добавляем историю сообщений
-        if chat_history:
-            messages_text = []
-            for msg in chat_history[-6:]:  # Берем последние 6 сообщений для контекста
-                if msg['is_bot']:
-                    messages_text.append(f"Ты написал:\n{msg['text']}")
-                else:
-                    # Очищаем сообщение пользователя от обращений к боту
-                    user_msg = msg['text']
-                    for trigger in triggers:
-                        user_msg = user_msg.replace(trigger, '').strip()
-                    user_msg = user_msg.replace(bot_mention, '').strip()
-                    messages_text.append(f"{username} написал:\n{user_msg}")
-            context_messages.append("\n".join(messages_text))
+        if len(items) == 1:
+            new_messages = f"Новое сообщение от {username}:\n{last['text']}"
+        else:
+            new_messages = "Новые сообщения:\n" + "\n".join(
+                f"{item['username']} написал:\n{item['text']}" for item in items
+            )
 
-        context_messages.append(f"Новое сообщение от {username}:\n{cleaned_message}")
+        # Формируем контекст с учетом истории: сколько поместится в бюджет токенов
+        context_messages = [f"Диалог с пользователем {username}"]
+        context_messages.extend(get_context_builder(context).build(
+            chat_id,
+            chat_history,
+            matcher,
+            reserved_tokens=estimate_tokens(new_messages)
+        ))
+        context_messages.append(new_messages)
 
-        prompt = f"{style_prompt}\n\n" + "\n\n".join(context_messages)
+        prompt = "\n\n".join(context_messages)
+        metrics.stage('prompt_build', time.monotonic() - prompt_started)
 
         print(f"\nПромпт для API:\n{prompt}\n")
-        response = await gemini_tester.generate_text_content(prompt)
+        if STREAM_REPLIES:
+            response = await send_streaming_reply(
+                context,
+                update.effective_chat.id,
+                reply_to_message_id,
+                gemini_tester.stream_text_content(prompt, priority=priority, system_instruction=system_instruction),
+                on_start=batch.commit
+            )
+        else:
+            response = await gemini_tester.generate_text_content(
+                prompt, priority=priority, system_instruction=system_instruction
+            )
 
+        batch.commit()
         if response['success']:
             response_text = response['text']
             print(f"\nОтвет API:\n{response_text}\n")
@@ -530,42 +3540,29 @@ async def handle_message(update: Update, context: CallbackContext):
                 is_bot=True
             )
 
-            try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=response_text,
-                    parse_mode='MarkdownV2',
-                    reply_to_message_id=update.effective_message.message_id
-                )
-            except Exception as format_error:
-                logging.error(f"Ошибка форматирования MarkdownV2: {format_error}")
-                try:
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=response_text,
-                        parse_mode='Markdown',
-                        reply_to_message_id=update.effective_message.message_id
-                    )
-                except Exception as markdown_error:
-                    logging.error(f"Ошибка Markdown форматирования: {markdown_error}")
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=response_text,
-                        reply_to_message_id=update.effective_message.message_id
-                    )
+            if not response.get('sent'):
+                await send_formatted_reply(context, update.effective_chat.id, response_text, reply_to_message_id)
+            # От первого сообщения пачки до готового ответа
+            metrics.stage('reply', time.monotonic() - items[0]['received'])
         else:
+            metrics.inc('bot_errors_total', where='reply')
+            error_text = f"😔 Произошла ошибка: {response.get('error', 'Неизвестная ошибка')}"
+            if response.get('circuit_open') or gemini_tester.breaker.is_open():
+                error_text = CIRCUIT_OPEN_REPLY
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=f"😔 Произошла ошибка: {response.get('error', 'Неизвестная ошибка')}",
-                reply_to_message_id=update.effective_message.message_id
+                text=error_text,
+                reply_to_message_id=reply_to_message_id
             )
 
     except Exception as e:
+        metrics.inc('bot_errors_total', where='handle_message')
         logging.error(f"Общая ошибка: {e}")
+        batch.commit()
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="😔 Произошла ошибка. Попробуйте повторить запрос позже.",
-            reply_to_message_id=update.effective_message.message_id
+            reply_to_message_id=reply_to_message_id
         )
 
 
@@ -601,15 +3598,20 @@ async def clear_history(update: Update, context: CallbackContext):
     history_manager = context.bot_data.get('history_manager')
     if history_manager:
         history_manager.clear_chat_history(chat_id)
+        if 'context_builder' in context.bot_data:
+            context.bot_data['context_builder'].reset(chat_id)
         await update.message.reply_text("✅ История сообщений очищена")
     else:
         await update.message.reply_text("❌ Система истории сообщений не инициализирована")
 
+@traced('image')
 async def handle_image_message(update: Update, context: CallbackContext):
     """Обработка изображений"""
     if not update.effective_message or not update.effective_message.photo:
         return
 
+    received = time.monotonic()
+    metrics.inc('bot_updates_total', kind='image')
     chat_id = str(update.effective_chat.id)
     chat_type = update.effective_chat.type
     caption = update.effective_message.caption or ''
@@ -622,27 +3624,23 @@ async def handle_image_message(update: Update, context: CallbackContext):
 
     try:
         # Сохраняем сообщение с картинкой в историю
-        context.bot_data.setdefault('history_manager', ChatHistoryManager())
+        # setdefault вычислял бы ChatHistoryManager() на каждое сообщение
+        if 'history_manager' not in context.bot_data:
+            context.bot_data['history_manager'] = ChatHistoryManager(backend=create_history_backend())
         history_manager = context.bot_data['history_manager']
-        history_manager.add_message(
-            chat_id=chat_id,
-            user_id=user_id,
-            message=f"[Изображение]{' с подписью: ' + caption if caption else ''}",
-            username=username,
-            is_bot=False
-        )
-
-        bot_username = (await context.bot.get_me()).username
-        bot_mention = f"@{bot_username}"
-        triggers = chat_triggers.get(chat_id, DEFAULT_TRIGGERS)
+        with tracer.span('history_add'):
+            history_manager.add_message(
+                chat_id=chat_id,
+                user_id=user_id,
+                message=f"[Изображение]{' с подписью: ' + caption if caption else ''}",
+                username=username,
+                is_bot=False
+            )
 
-        is_bot_mentioned = any(
-            word.lower() in caption.lower() for word in triggers) or bot_mention.lower() in caption.lower()
-        is_reply_to_bot = (
-                update.effective_message.reply_to_message and
-                update.effective_message.reply_to_message.from_user and
-                update.effective_message.reply_to_message.from_user.id == context.bot.id
-        )
+        await resolve_bot_username(context.bot)
+        with tracer.span('trigger_match'):
+            is_bot_mentioned = get_trigger_matcher(chat_id).matches(caption)
+            is_reply_to_bot = is_reply_to(update.effective_message, context.bot.id)
 
     except Exception as e:
         logging.error(f"Ошибка при обработке упоминаний в изображении: {e}")
@@ -654,46 +3652,72 @@ async def handle_image_message(update: Update, context: CallbackContext):
             is_reply_to_bot
     )
 
+    tracer.annotate(respond=should_respond)
     if not should_respond:
         return
 
-    style_prompt = context.chat_data.get('style_prompt',
-                                         "Отвечай блять, как двачер. Если описываешь изображение, то уложись в 600 "
-                                         "символов (ЕСЛИ НУЖНО, то в ответе запрещёнку завуалируй смайликами):")
+    priority = PRIORITY_HIGH if chat_type == 'private' or is_reply_to_bot else PRIORITY_NORMAL
+
+    if gemini_tester.breaker.is_open():
+        # Gemini недоступен — не скачиваем картинку и отвечаем сразу
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=CIRCUIT_OPEN_REPLY,
+            reply_to_message_id=update.effective_message.message_id
+        )
+        return
+
+    system_instruction = chat_system_instruction(chat_id, DEFAULT_IMAGE_STYLE_PROMPT)
 
+    # Стиль уже в системных инструкциях; в промпте — только то, что относится к этой картинке
+    prompt_parts = ["Ответь на изображение."]
     if chat_type != 'private':
-        style_prompt = f"{style_prompt}\nОтветь юзеру {username or 'Неизвестный'}"
+        prompt_parts.append(f"Ответь юзеру {username or 'Неизвестный'}")
 
     try:
-        photo_file = await update.effective_message.photo[-1].get_file()
-        # Используем временный файл с уникальным именем
-        import uuid
-        temp_filename = f"temp_{uuid.uuid4()}.jpg"
-        photo_path = os.path.join(os.getcwd(), temp_filename)
+        photo = update.effective_message.photo[-1]
+        image_cache = gemini_tester.image_cache
 
         try:
-            # Загружаем файл
-            await photo_file.download_to_drive(photo_path)
-
-            # Проверяем, что файл существует и доступен
-            if not os.path.exists(photo_path):
-                raise FileNotFoundError("Downloaded file not found")
+            # Картинку, уже загруженную в Gemini или сохранённую в кеше байтами, повторно не скачиваем
+            image_file = image_cache.get(image_cache.telegram_key(photo.file_unique_id)) if image_cache else None
+            image_data = None
+            if image_file is None:
+                # Скачиваем изображение сразу в память, без временных файлов
+                with metrics.timer('image_download'):
+                    image_data = bytes(await (await photo.get_file()).download_as_bytearray())
 
             if caption:
-                style_prompt = f"{style_prompt}\nПодпись к изображению: {caption}"
+                prompt_parts.append(f"Подпись к изображению: {caption}")
 
             if is_reply_to_bot and update.effective_message.reply_to_message and update.effective_message.reply_to_message.text:
-                style_prompt = f"{style_prompt}\nРанее ты ответил: {update.effective_message.reply_to_message.text}"
-
-            # Добавляем небольшую задержку перед обработкой файла
-            await asyncio.sleep(0.5)
+                prompt_parts.append(f"Ранее ты ответил: {update.effective_message.reply_to_message.text}")
 
+            prompt = "\n".join(prompt_parts)
             response = await gemini_tester.generate_image_content_stream(
-                prompt=style_prompt,
-                image_path=photo_path,
-                max_retries=3
+                prompt=prompt,
+                image_data=image_data,
+                image_file=image_file,
+                image_id=photo.file_unique_id,
+                max_retries=3,
+                priority=priority,
+                system_instruction=system_instruction
             )
 
+            if response.get('file_missing'):
+                # Файл удалён на стороне Gemini раньше срока (запись кеша уже сброшена) — загружаем заново
+                if image_data is None:
+                    with metrics.timer('image_download'):
+                        image_data = bytes(await (await photo.get_file()).download_as_bytearray())
+                response = await gemini_tester.generate_image_content_stream(
+                    prompt=prompt,
+                    image_data=image_data,
+                    image_id=photo.file_unique_id,
+                    max_retries=3,
+                    priority=priority,
+                    system_instruction=system_instruction
+                )
+
             if response['success'] or response.get('text'):
                 response_text = response.get('text', '')
 
@@ -706,32 +3730,15 @@ async def handle_image_message(update: Update, context: CallbackContext):
                     is_bot=True
                 )
 
-                try:
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=response_text,
-                        parse_mode='MarkdownV2',
-                        reply_to_message_id=update.effective_message.message_id
-                    )
-                except Exception as format_error:
-                    logging.error(f"Ошибка форматирования MarkdownV2: {format_error}")
-                    try:
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=response_text,
-                            parse_mode='Markdown',
-                            reply_to_message_id=update.effective_message.message_id
-                        )
-                    except Exception as markdown_error:
-                        logging.error(f"Ошибка Markdown форматирования: {markdown_error}")
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=response_text,
-                            reply_to_message_id=update.effective_message.message_id
-                        )
+                await send_formatted_reply(context, update.effective_chat.id, response_text,
+                                           update.effective_message.message_id)
+                metrics.stage('reply', time.monotonic() - received)
             else:
+                metrics.inc('bot_errors_total', where='image_reply')
                 error_message = "😔 Не удалось обработать изображение"
-                if response.get('metadata', {}).get('was_blocked'):
+                if response.get('circuit_open'):
+                    error_message = CIRCUIT_OPEN_REPLY
+                elif response.get('metadata', {}).get('was_blocked'):
                     error_message += " (контент заблокирован)"
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
@@ -740,6 +3747,7 @@ async def handle_image_message(update: Update, context: CallbackContext):
                 )
 
         except Exception as e:
+            metrics.inc('bot_errors_total', where='handle_image_message')
             logging.error(f"Ошибка при обработке изображения: {str(e)}")
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -747,16 +3755,8 @@ async def handle_image_message(update: Update, context: CallbackContext):
                 reply_to_message_id=update.effective_message.message_id
             )
 
-        finally:
-            # Добавляем задержку перед удалением файла
-            await asyncio.sleep(0.5)
-            try:
-                if os.path.exists(photo_path):
-                    os.remove(photo_path)
-            except Exception as e:
-                logging.error(f"Ошибка при удалении временного файла: {str(e)}")
-
     except Exception as e:
+        metrics.inc('bot_errors_total', where='handle_image_message')
         logging.error(f"Общая ошибка: {str(e)}")
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -775,14 +3775,16 @@ async def add_trigger(update: Update, context: CallbackContext):
     new_trigger = context.args[0].lower()
 
     # Инициализируем список триггеров для чата, если его еще нет
-    if chat_id not in chat_triggers:
-        chat_triggers[chat_id] = set(DEFAULT_TRIGGERS)
+    triggers = get_chat_triggers(chat_id)
+    if triggers is None:
+        triggers = set(DEFAULT_TRIGGERS)
 
     # Добавляем новый триггер
-    chat_triggers[chat_id].add(new_trigger)
+    triggers.add(new_trigger)
+    set_chat_triggers(chat_id, triggers)
 
     await update.message.reply_text(f"✅ Триггерное слово '{new_trigger}' добавлено\n"
-                                    f"Текущие триггеры: {', '.join(sorted(chat_triggers[chat_id]))}")
+                                    f"Текущие триггеры: {', '.join(sorted(triggers))}")
 
 
 async def remove_trigger(update: Update, context: CallbackContext):
@@ -795,13 +3797,15 @@ async def remove_trigger(update: Update, context: CallbackContext):
 
     trigger = context.args[0].lower()
 
-    if chat_id not in chat_triggers:
-        chat_triggers[chat_id] = set(DEFAULT_TRIGGERS)
+    triggers = get_chat_triggers(chat_id)
+    if triggers is None:
+        triggers = set(DEFAULT_TRIGGERS)
 
-    if trigger in chat_triggers[chat_id]:
-        chat_triggers[chat_id].remove(trigger)
+    if trigger in triggers:
+        triggers.remove(trigger)
+        set_chat_triggers(chat_id, triggers)
         await update.message.reply_text(f"✅ Триггерное слово '{trigger}' удалено\n"
-                                        f"Текущие триггеры: {', '.join(sorted(chat_triggers[chat_id]))}")
+                                        f"Текущие триггеры: {', '.join(sorted(triggers))}")
     else:
         await update.message.reply_text(f"❌ Триггерное слово '{trigger}' не найдено")
 
@@ -810,28 +3814,36 @@ async def list_triggers(update: Update, context: CallbackContext):
     """Показать список текущих триггерных слов"""
     chat_id = str(update.effective_chat.id)
 
-    triggers = chat_triggers.get(chat_id, DEFAULT_TRIGGERS)
+    triggers = get_chat_triggers(chat_id)
+    if triggers is None:
+        triggers = DEFAULT_TRIGGERS
     await update.message.reply_text(f"📝 Текущие триггерные слова:\n{', '.join(sorted(triggers))}")
 
 
 async def set_system_instructions(update: Update, context: CallbackContext):
-    """Установка системных инструкций для бота"""
+    """Установка системных инструкций бота для текущего чата"""
+    chat_id = str(update.effective_chat.id)
+    gemini_instance = context.bot_data.get('gemini_tester')
     if not context.args:
+        current = chat_settings.get(chat_id, 'system_instructions') or (
+            gemini_instance.system_instructions if gemini_instance else '')
         await update.message.reply_text(
-            "ℹ️ Использование: /set_instructions <инструкции>\n"
+            "ℹ️ Использование: /set_instructions <инструкции> (или /set_instructions reset — вернуть общие)\n"
             "Текущие системные инструкции:\n"
-            f"{context.bot_data.get('gemini_tester').system_instructions}"
+            f"{current}"
         )
         return
 
     new_instructions = " ".join(context.args)
     try:
-        gemini_instance = context.bot_data.get('gemini_tester')
         if gemini_instance:
-            # Обновляем инструкции и переинициализируем модель
-            gemini_instance.system_instructions = new_instructions
-            gemini_instance.model = gemini_instance._initialize_model()
-            await update.message.reply_text("✅ Системные инструкции обновлены")
+            # Инструкции действуют только в этом чате; модель под них берётся из кеша моделей
+            if new_instructions.lower() == 'reset':
+                chat_settings.set(chat_id, 'system_instructions', None)
+                await update.message.reply_text("✅ Восстановлены общие системные инструкции")
+            else:
+                chat_settings.set(chat_id, 'system_instructions', new_instructions)
+                await update.message.reply_text("✅ Системные инструкции обновлены")
         else:
             await update.message.reply_text("❌ Ошибка: экземпляр GeminiTester не найден")
     except Exception as e:
@@ -853,14 +3865,17 @@ async def handle_new_chat_members(update: Update, context: CallbackContext):
                      "/style - изменить стиль общения\n"
                      "/clear_history - очистить историю ваших сообщений\n"
                      "/show_history - показать ваши последние сообщения\n"
-                     "/set_instructions - установить системные инструкции для бота"
+                     "/set_instructions - установить системные инструкции для этого чата"
             )
 
 
 async def check_telegram_bot(application):
     """Проверка инициализации Telegram-бота"""
+    global bot_username
     try:
         bot_info = await application.bot.get_me()
+        bot_username = bot_info.username
+        invalidate_trigger_matcher()
         logging.getLogger('telegram_api').info(
             f"Бот успешно инициализирован: {bot_info.first_name} (@{bot_info.username})")
         await application.bot.send_message(chat_id=YOUR_CHAT_ID, text="🚀 Бот успешно запущен и готов к работе.")
@@ -874,30 +3889,427 @@ async def set_style(update: Update, context: CallbackContext):
     """Установка стиля для генерации ответов"""
     if context.args:
         new_style = " ".join(context.args)
-        context.chat_data['style_prompt'] = new_style
+        chat_settings.set(str(update.effective_chat.id), 'style_prompt', new_style)
         await update.message.reply_text(f"✅ Стиль успешно обновлен:\n{new_style}")
     else:
         await update.message.reply_text("ℹ️ Укажите стиль после команды /style.")
 
 
+async def start_profiling(update: Update, context: CallbackContext):
+    """Запуск профилировщика на заданное число секунд (только из YOUR_CHAT_ID)"""
+    if str(update.effective_chat.id) != str(YOUR_CHAT_ID):
+        return
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("ℹ️ Использование: /profile [секунды]")
+        return
+
+    seconds = min(max(seconds, 1.0), PROFILE_MAX_SECONDS)
+    path = profiler.start(seconds)
+    if path is None:
+        await update.message.reply_text("⏳ Профилировщик уже запущен")
+    else:
+        await update.message.reply_text(f"🔬 Профилирование на {seconds:g} с, результат будет в {path}")
+
+
 async def error_handler(update: object, context: CallbackContext) -> None:
     """Обработчик ошибок для бота"""
+    metrics.inc('bot_errors_total', where='handler')
     logging.error(f"Exception while handling an update: {context.error}")
 
 
-async def main():
-    """Главная функция"""
-    global gemini_tester
-    gemini_tester = GeminiTester(GEMINI_API_KEY)
+async def on_stop(application):
+    """
+    Дожидаемся принятых обновлений и отложенных пачек сообщений, пока бот ещё может отвечать:
+    после Application.stop() очередь обработчика и дебаунсер ещё содержат работу, а on_shutdown
+    закрывает историю и настройки, в которые она пишет.
+    """
+    processor = application.bot_data.get('update_processor')
+    if processor:
+        await processor.shutdown()
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    debouncer = application.bot_data.get('debouncer')
+    if debouncer:
+        await debouncer.close()
 
-    if not await check_telegram_bot(application):
-        logging.getLogger('telegram_api').error("Инициализация Telegram-бота не удалась. Завершение работы.")
-        return
 
+async def on_shutdown(application):
+    """Сброс несохранённой истории и настроек чатов при остановке бота (после on_stop)"""
+    dispatcher = application.bot_data.get('shard_dispatcher')
+    if dispatcher:
+        await dispatcher.close()
+
+    history_manager = application.bot_data.get('history_manager')
+    if history_manager:
+        await history_manager.close()
+
+    tester = application.bot_data.get('gemini_tester')
+    if tester and tester.image_cache:
+        tester.image_cache.save()
+    if tester and tester.context_cache:
+        await tester.context_cache.close()
+
+    await chat_settings.close()
+    await tracer.close()
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработка обновлений PTB: разные чаты — параллельно, внутри чата — строго по порядку.
+
+    У каждого чата своя очередь не длиннее max_queue; при переполнении самое старое
+    ожидающее обновление отбрасывается или (overflow="merge") его текст без ответа
+    записывается в историю через merge(update). Глубина очередей видна в get_stats().
+
+    Слот PTB освобождается сразу после постановки в очередь: одновременно выполняется
+    не больше max_concurrent_updates обновлений, но ждущие в очереди своего чата слоты
+    не занимают, поэтому заваленный сообщениями чат не задерживает остальные.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_MAX_CONCURRENCY,
+                 max_queue: int = UPDATE_QUEUE_PER_CHAT, overflow: str = UPDATE_QUEUE_OVERFLOW, merge=None):
+        super().__init__(max_concurrent_updates)
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.merge = merge
+        # chat_id -> ожидающие (update, coroutine); выполняющееся обновление уже извлечено
+        self._queues: Dict[Any, deque] = {}
+        self._drains: Dict[Any, asyncio.Task] = {}
+        # Собственное ограничение параллельности: семафор PTB отпускается сразу после постановки
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self.stats = {'processed': 0, 'dropped': 0, 'merged': 0, 'max_depth': 0}
+
+    @staticmethod
+    def _chat_id(update):
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat else None
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = self._chat_id(update)
+        if chat_id is None:
+            # Обновления без чата порядка не требуют
+            await coroutine
+            return
+
+        queue = self._queues.setdefault(chat_id, deque())
+        queue.append((update, coroutine))
+        if len(queue) > self.max_queue:
+            self._shed(queue)
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(queue))
+
+        if chat_id not in self._drains:
+            self._drains[chat_id] = asyncio.create_task(self._drain(chat_id, queue))
+
+    def _shed(self, queue: deque):
+        """Освобождение места в переполненной очереди чата"""
+        victim = 0
+        if self.overflow == "merge" and self.merge is not None:
+            # Сливаем самое старое обычное текстовое сообщение; команды и фото не трогаем
+            for index, (update, _) in enumerate(queue):
+                message = getattr(update, 'effective_message', None)
+                if message is not None and message.text and not message.text.startswith('/'):
+                    victim = index
+                    break
+
+        update, coroutine = queue[victim]
+        del queue[victim]
+        coroutine.close()
+        message = getattr(update, 'effective_message', None)
+        if self.overflow == "merge" and self.merge is not None and message is not None and message.text \
+                and not message.text.startswith('/'):
+            try:
+                self.merge(update)
+                self.stats['merged'] += 1
+            except Exception as e:
+                logging.error(f"Ошибка при слиянии обновления: {e}")
+                self.stats['dropped'] += 1
+        else:
+            self.stats['dropped'] += 1
+
+    async def _drain(self, chat_id, queue: deque):
+        try:
+            while queue:
+                async with self._slots:
+                    # Очередь могла опустеть, пока ждали слот
+                    if not queue:
+                        break
+                    update, coroutine = queue.popleft()
+                    try:
+                        await coroutine
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки обновления чата {chat_id}: {e}")
+                    finally:
+                        self.stats['processed'] += 1
+        finally:
+            del self._drains[chat_id]
+            if self._queues.get(chat_id) is queue and not queue:
+                del self._queues[chat_id]
+
+    def get_stats(self, top: int = 10) -> Dict[str, Any]:
+        depths = sorted(((chat_id, len(queue)) for chat_id, queue in self._queues.items()),
+                        key=lambda item: item[1], reverse=True)
+        return {
+            **self.stats,
+            'active_chats': len(self._drains),
+            'queued': sum(depth for _, depth in depths),
+            'deepest': depths[:top],
+        }
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        """Дожидаемся уже принятых обновлений"""
+        if self._drains:
+            await asyncio.gather(*self._drains.values(), return_exceptions=True)
+
+
+def record_without_reply(application):
+    """merge для ChatOrderedUpdateProcessor: сообщение сохраняется в историю как контекст, без ответа"""
+    def merge(update):
+        history_manager = application.bot_data.get('history_manager')
+        message = update.effective_message
+        if history_manager is None or not message.text:
+            return
+        history_manager.add_message(
+            chat_id=str(update.effective_chat.id),
+            user_id=str(message.from_user.id) if message.from_user else '',
+            message=message.text,
+            username=message.from_user.username if message.from_user else None
+        )
+    return merge
+
+
+def build_application(**kwargs):
+    """Application с параллельной обработкой разных чатов и порядком внутри чата"""
+    processor = ChatOrderedUpdateProcessor()
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(processor)
+    for name, value in kwargs.items():
+        builder = getattr(builder, name)(value)
+    application = builder.build()
+    processor.merge = record_without_reply(application)
+    application.bot_data['update_processor'] = processor
+    return application
+
+
+def shard_for(chat_id, shards: int) -> int:
+    """Номер обработчика для чата; crc32, а не hash(): он одинаков во всех процессах"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+
+def shard_path(path: str, shard: int) -> str:
+    """Файл состояния обработчика: chat_settings.json -> chat_settings.shard2.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+def update_chat_id(data: Dict[str, Any]) -> Optional[int]:
+    """chat_id из обновления в формате Bot API"""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+                'chat_member', 'chat_join_request'):
+        if data.get(key):
+            return data[key].get('chat', {}).get('id')
+    callback_query = data.get('callback_query')
+    if callback_query and callback_query.get('message'):
+        return callback_query['message'].get('chat', {}).get('id')
+    return None
+
+
+class ProcessShardTransport:
+    """Шарды в отдельных процессах: у каждого своя очередь multiprocessing и свой цикл событий"""
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        # spawn: дочерний процесс не наследует цикл событий и соединения родителя
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._processes = []
+
+    def start(self):
+        for shard in range(self.shards):
+            queue = self._context.Queue()
+            process = self._context.Process(
+                target=_shard_process_main, args=(shard, self.shards, queue), name=f"shard-{shard}", daemon=True
+            )
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+    async def send(self, shard: int, data: Dict[str, Any]):
+        self._queues[shard].put_nowait(data)
+
+    async def close(self):
+        for queue in self._queues:
+            queue.put_nowait(None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 30)
+            if process.is_alive():
+                process.terminate()
+
+
+class ShardDispatcher:
+    """Раздача обновлений по шардам: все обновления одного чата попадают в один шард по порядку"""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.shards = transport.shards
+        self.stats = {'routed': [0] * self.shards}
+
+    def start(self):
+        self.transport.start()
+
+    async def route(self, data: Dict[str, Any]):
+        chat_id = update_chat_id(data)
+        shard = shard_for(chat_id, self.shards) if chat_id is not None else 0
+        self.stats['routed'][shard] += 1
+        await self.transport.send(shard, data)
+
+    async def handle_update(self, update: Update, context: CallbackContext):
+        """Обработчик PTB в основном процессе: обновление уходит в шард без разбора"""
+        await self.route(update.to_dict())
+
+    async def close(self):
+        await self.transport.close()
+
+
+async def run_shard_worker(shard: int, shards: int, receive):
+    """
+    Обработчик шарда: собственные Gemini-клиент, история и настройки, обычные обработчики PTB.
+    receive() возвращает следующее обновление в формате Bot API или None для остановки.
+    """
+    global gemini_tester, chat_settings, tracer
+    chat_settings = ChatSettingsStore(
+        shard_path(SETTINGS_PATH, shard),
+        owns=lambda chat_id: shard_for(chat_id, shards) == shard
+    )
+    gemini_tester = create_gemini_tester(shard_path(IMAGE_CACHE_PATH, shard))
+    tracer = Tracer(shard_path(TRACE_PATH, shard))
+
+    # Обновления приходят от диспетчера, собственный приём не нужен
+    application = build_application(updater=None)
+    register_handlers(application)
+
+    async with application:
+        register_metrics(application)
+        install_profiler_signal()
+        if METRICS_ENABLED:
+            await start_metrics_server(port=METRICS_PORT + 1 + shard)
+        await application.start()
+        logging.getLogger('shard').info(f"Shard {shard}/{shards} started (pid {os.getpid()})")
+        try:
+            while True:
+                data = await receive()
+                if data is None:
+                    break
+                # Через очередь Application, чтобы обновления шли через ChatOrderedUpdateProcessor
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            await on_stop(application)
+    await on_shutdown(application)
+
+
+def _shard_process_main(shard: int, shards: int, queue):
+    asyncio.run(run_shard_worker(shard, shards, lambda: asyncio.to_thread(queue.get)))
+
+
+def build_fake_update(text: str, chat_id: int, update_id: Optional[int] = None, user_id: int = 1,
+                      username: str = "tester", chat_type: str = "private") -> Dict[str, Any]:
+    """Обновление в формате Bot API с одним текстовым сообщением"""
+    update_id = update_id if update_id is not None else int(time.time() * 1000) % 2 ** 31
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': chat_type},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+        },
+    }
+
+
+def webhook_secret_token() -> str:
+    """Секрет вебхука: WEBHOOK_SECRET_TOKEN или производный от токена бота (Telegram допускает [A-Za-z0-9_-])"""
+    return WEBHOOK_SECRET_TOKEN or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode('utf-8')).hexdigest()
+
+
+async def send_fake_update(text: str, chat_id: int, url: Optional[str] = None,
+                           secret_token: Optional[str] = None, **kwargs) -> int:
+    """
+    Локальная замена Telegram для проверки вебхука: отправляет обновление на адрес бота
+    так же, как это делает Telegram (с тем же секретом, что ждёт сервер), и возвращает HTTP-статус ответа.
+    """
+    url = url or f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH.strip('/')}"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token or webhook_secret_token()}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(url, json=build_fake_update(text, chat_id, **kwargs), headers=headers)
+    return response.status_code
+
+
+def create_gemini_tester(image_cache_path: str = IMAGE_CACHE_PATH) -> GeminiTester:
+    context_cache = None
+    if CONTEXT_CACHE_ENABLED:
+        backend = FakeContextCacheBackend() if CONTEXT_CACHE_BACKEND == "fake" else GeminiContextCacheBackend()
+        context_cache = ContextCache(backend)
+
+    return GeminiTester(
+        GEMINI_API_KEY,
+        image_cache=UploadedImageCache(image_cache_path) if IMAGE_CACHE_ENABLED else None,
+        api_keys=GEMINI_API_KEYS or None,
+        context_cache=context_cache
+    )
+
+
+def register_metrics(application):
+    """Датчики состояния очередей и предохранителя для /metrics"""
+    processor = application.bot_data.get('update_processor')
+    if processor is not None:
+        metrics.gauge('bot_update_queue_depth', lambda: processor.get_stats()['queued'],
+                      "Updates waiting in per-chat queues")
+        metrics.gauge('bot_update_active_chats', lambda: processor.get_stats()['active_chats'],
+                      "Chats with an update being processed")
+    tester = application.bot_data.get('gemini_tester')
+    if isinstance(tester, GeminiTester):
+        metrics.gauge('bot_gemini_in_flight', lambda: tester.pool_stats['in_flight'], "Gemini calls in progress")
+        metrics.gauge('bot_gemini_queued', lambda: tester.pool_stats['queued'], "Gemini calls waiting for a slot")
+        metrics.gauge('bot_circuit_open', lambda: 1 if tester.breaker.state != CircuitBreaker.CLOSED else 0,
+                      "1 if the Gemini circuit breaker is open or half-open")
+        key_pool = tester.key_pool
+
+        def per_key(field):
+            return lambda: {stats['key']: stats[field] for stats in key_pool.get_stats()}
+
+        for field, description in (
+                ('requests', "Gemini requests sent with each API key"),
+                ('tokens', "Tokens (usage_metadata) spent by each API key"),
+                ('errors', "Failed Gemini requests, by API key"),
+                ('quota_errors', "429 responses, by API key"),
+                ('auth_errors', "Rejections as an invalid key, by API key"),
+                ('quarantined_for', "Seconds left until the key returns to rotation (0 if it is in rotation)"),
+                ('budget', "Share of the key's quota left (0 if paused after 429)")):
+            metrics.gauge(f'bot_gemini_key_{field}', per_key(field), description)
+        metrics.gauge('bot_response_coalescer', tester.coalescer.get_stats,
+                      "Response coalescer: cache hits and misses, coalesced and cancelled requests, "
+                      "cached and in-flight entries", label='stat')
+    dispatcher = application.bot_data.get('shard_dispatcher')
+    if dispatcher is not None:
+        metrics.gauge('bot_shard_routed', lambda: dict(enumerate(dispatcher.stats['routed'])),
+                      "Updates routed to each shard")
+
+
+async def on_startup(application):
+    register_metrics(application)
+    install_profiler_signal()
+    if METRICS_ENABLED:
+        await start_metrics_server()
+
+
+def register_handlers(application):
+    """Обработчики бота и его состояние (история, Gemini) в bot_data"""
     # Инициализация менеджера истории
-    application.bot_data['history_manager'] = ChatHistoryManager()
+    application.bot_data['history_manager'] = ChatHistoryManager(backend=create_history_backend())
     application.bot_data['gemini_tester'] = gemini_tester
     application.add_handler(CommandHandler('style', set_style))
     application.add_handler(CommandHandler('add_trigger', add_trigger))
@@ -906,6 +4318,7 @@ async def main():
     application.add_handler(CommandHandler('clear_history', clear_history))
     application.add_handler(CommandHandler('show_history', show_history))
     application.add_handler(CommandHandler('set_instructions', set_system_instructions))
+    application.add_handler(CommandHandler('profile', start_profiling))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.PHOTO, handle_image_message))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_chat_members))
@@ -913,11 +4326,56 @@ async def main():
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
 
-    await application.run_polling(allowed_updates=Update.ALL_TYPES)
 
-    # await application.run_polling()
+async def main(update_mode: str = UPDATE_MODE, shards: int = SHARD_WORKERS):
+    """Главная функция"""
+    global gemini_tester
+
+    if update_mode == "webhook" and not WEBHOOK_URL:
+        # Иначе PTB зарегистрировал бы в Telegram адрес https://0.0.0.0:8443/...
+        logging.getLogger('telegram_api').error("Для режима webhook задайте WEBHOOK_URL. Завершение работы.")
+        return
+
+    application = build_application(post_init=on_startup, post_stop=on_stop, post_shutdown=on_shutdown)
+
+    if not await check_telegram_bot(application):
+        logging.getLogger('telegram_api').error("Инициализация Telegram-бота не удалась. Завершение работы.")
+        return
+
+    if shards > 1:
+        # Этот процесс только принимает обновления; обрабатывают их процессы-шарды
+        dispatcher = ShardDispatcher(ProcessShardTransport(shards))
+        dispatcher.start()
+        application.bot_data['shard_dispatcher'] = dispatcher
+        application.add_handler(TypeHandler(Update, dispatcher.handle_update))
+    else:
+        gemini_tester = create_gemini_tester()
+        register_handlers(application)
+
+    if update_mode == "webhook":
+        url_path = WEBHOOK_PATH.strip('/')
+        await application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+            secret_token=webhook_secret_token(),
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        await application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-history':
+        # python bot.py migrate-history [каталог с json] [путь к базе]
+        print(migrate_json_history(*sys.argv[2:4]))
+        sys.exit(0)
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'fake-update':
+        # python bot.py fake-update <текст> [chat_id] — обновление на локальный вебхук
+        print(asyncio.run(send_fake_update(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1)))
+        sys.exit(0)
+
     nest_asyncio.apply()
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ('polling', 'webhook') else UPDATE_MODE))
\ No newline at end of file
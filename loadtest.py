@@ -0,0 +1,507 @@
+"""
+Нагрузочный тест бота без сети и настоящих токенов.
+
+Обновления проходят через очередь Application и ChatOrderedUpdateProcessor, как в режиме вебхука,
+и попадают в настоящие обработчики bot.py (handle_message, handle_image_message). Запросы к
+Telegram уходят на локальный поддельный Bot API, запросы к Gemini — в поддельную модель с
+настраиваемой задержкой, темпом стриминга и долей ошибок и 429.
+
+    python loadtest.py --chats 50 --rate 20 --duration 30 --gemini-latency 0.8 --error-rate 0.05
+
+В конце печатаются пропускная способность, p50/p95/p99 задержки ответа и задержка цикла событий.
+Задержка считается для каждого обращённого к боту сообщения — от его отправки до ответа, который
+его покрывает: на серию сообщений, объединённую дебаунсером, бот отвечает на последнее из них.
+С --fail-p95 скрипт завершается с кодом 1, если p95 задержки первого ответа больше порога.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote
+
+from google.api_core import exceptions as google_exceptions
+
+import bot
+
+LOADTEST_TOKEN = "123456:LOADTEST"
+# Минимальный JPEG: обработчику нужны только байты, Gemini здесь поддельный
+FAKE_IMAGE = bytes.fromhex("ffd8ffe000104a46494600010100000100010000ffd9")
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Процентиль по ближайшему рангу"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class FakeTelegramServer:
+    """
+    Поддельный Bot API на asyncio.start_server: getMe, sendMessage, editMessageText, getFile
+    и скачивание файлов, остальные методы просто возвращают True. Каждый ответ бота на
+    сообщение передаётся в on_reply(chat_id, reply_to_message_id, text, время).
+    """
+
+    def __init__(self, token: str = LOADTEST_TOKEN, username: str = "loadtest_bot", on_reply=None,
+                 on_edit=None):
+        self.token = token
+        self.user = {'id': int(token.split(':')[0]), 'is_bot': True, 'first_name': 'Load test',
+                     'username': username}
+        self.on_reply = on_reply
+        self.on_edit = on_edit
+        self.last_activity = time.monotonic()
+        self.stats: Dict[str, int] = {}
+        self._message_ids = itertools.count(1_000_000)
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Соединения keep-alive: httpx переиспользует их, как с настоящим api.telegram.org
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+
+                method, path = request_line.decode('latin-1').split()[:2]
+                status, content_type, payload = self._dispatch(method, unquote(path.split('?')[0]), headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_body(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        if not body:
+            return {}
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body)
+        return {name: values[0] for name, values in parse_qs(body.decode('utf-8')).items()}
+
+    @staticmethod
+    def _json_param(params: Dict[str, Any], name: str):
+        value = params.get(name)
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        return value
+
+    def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.last_activity = time.monotonic()
+        if method == 'GET' and path.startswith(f"/file/bot{self.token}/"):
+            self.stats['download'] = self.stats.get('download', 0) + 1
+            return '200 OK', 'image/jpeg', FAKE_IMAGE
+
+        prefix = f"/bot{self.token}/"
+        if not path.startswith(prefix):
+            return '404 Not Found', 'application/json', b'{"ok": false, "error_code": 404, "description": "Not Found"}'
+
+        api_method = path[len(prefix):]
+        self.stats[api_method] = self.stats.get(api_method, 0) + 1
+        params = self._parse_body(headers, body)
+        result = self._call(api_method, params)
+        return '200 OK', 'application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    def _message(self, chat_id, message_id: int, text: str) -> Dict[str, Any]:
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.user,
+            'text': text,
+        }
+
+    def _call(self, api_method: str, params: Dict[str, Any]):
+        now = time.monotonic()
+        if api_method == 'getMe':
+            return self.user
+
+        if api_method == 'sendMessage':
+            chat_id = self._json_param(params, 'chat_id')
+            reply_to = self._json_param(params, 'reply_to_message_id')
+            if reply_to is None:
+                # Новые версии PTB передают ответ через reply_parameters
+                reply_to = (self._json_param(params, 'reply_parameters') or {}).get('message_id')
+            message_id = next(self._message_ids)
+            text = params.get('text', '')
+            if self.on_reply and reply_to is not None:
+                self.on_reply(chat_id, int(reply_to), message_id, text, now)
+            return self._message(chat_id, message_id, text)
+
+        if api_method == 'editMessageText':
+            chat_id = self._json_param(params, 'chat_id')
+            message_id = int(self._json_param(params, 'message_id'))
+            if self.on_edit:
+                self.on_edit(chat_id, message_id, now)
+            return self._message(chat_id, message_id, params.get('text', ''))
+
+        if api_method == 'getFile':
+            file_id = params.get('file_id', '')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(FAKE_IMAGE),
+                    'file_path': f"photos/{file_id}.jpg"}
+
+        return True
+
+
+class FakeGeminiModel:
+    """
+    Замена GenerativeModel: ответ приходит через latency секунд (± jitter), стрим отдаёт
+    chunks кусков с интервалом chunk_interval. Доля error_rate запросов падает с 503,
+    доля quota_rate — с 429 (RESOURCE_EXHAUSTED), как у настоящего API.
+    """
+
+    model_name = "fake-gemini"
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, chunks: int = 5, chunk_interval: float = 0.1,
+                 error_rate: float = 0.0, quota_rate: float = 0.0, reply_chars: int = 400):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = max(1, chunks)
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.reply_chars = reply_chars
+        self.stats = {'calls': 0, 'streams': 0, 'errors': 0, 'quota_errors': 0}
+
+    @staticmethod
+    def _response(text: str, prompt_tokens: int, output_tokens: int):
+        return SimpleNamespace(
+            text=text,
+            prompt_feedback=None,
+            candidates=[],
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens
+            )
+        )
+
+    def _maybe_fail(self):
+        roll = random.random()
+        if roll < self.quota_rate:
+            self.stats['quota_errors'] += 1
+            raise google_exceptions.ResourceExhausted("Resource has been exhausted (e.g. check quota).")
+        if roll < self.quota_rate + self.error_rate:
+            self.stats['errors'] += 1
+            raise google_exceptions.ServiceUnavailable("The model is overloaded. Please try again later.")
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        self.stats['calls'] += 1
+        await asyncio.sleep(max(0.0, self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)))
+        self._maybe_fail()
+
+        prompt_tokens = bot.estimate_tokens(str(contents))
+        text = ("Ответ нагрузочного теста. " * (self.reply_chars // 26 + 1))[:self.reply_chars]
+        output_tokens = bot.estimate_tokens(text)
+        if not stream:
+            return self._response(text, prompt_tokens, output_tokens)
+
+        self.stats['streams'] += 1
+        return self._stream(text, prompt_tokens, output_tokens)
+
+    async def _stream(self, text: str, prompt_tokens: int, output_tokens: int):
+        size = len(text) // self.chunks + 1
+        for index in range(self.chunks):
+            if index:
+                await asyncio.sleep(self.chunk_interval)
+            part = text[index * size:(index + 1) * size]
+            if part:
+                yield self._response(part, prompt_tokens, output_tokens * (index + 1) // self.chunks)
+
+
+class FakeGeminiTester(bot.GeminiTester):
+    """GeminiTester, у которого каждый ключ и набор инструкций получают одну поддельную модель"""
+
+    def __init__(self, model: FakeGeminiModel, rpm: int, tpm: int, **kwargs):
+        super().__init__("loadtest", api_keys=[{'api_key': "loadtest", 'rpm': rpm, 'tpm': tpm}], **kwargs)
+        self.fake_model = model
+
+    def get_model(self, key=None, system_instruction=None, generation_config=None):
+        return self.fake_model
+
+
+class LoadTest:
+    """Синтетический трафик по многим чатам и замер задержек ответа"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        # chat_id -> обращённые к боту сообщения без ответа: [(message_id, время отправки)]
+        self.pending: Dict[int, List[tuple]] = {}
+        # Задержка первого ответа для каждого обращённого сообщения
+        self.first_reply: List[float] = []
+        # (chat_id, message_id ответа бота) -> [времена отправки покрытых сообщений, время последнего изменения]
+        self.replies: Dict[tuple, list] = {}
+        self.error_replies = 0
+        self.loop_lag: List[float] = []
+        self._update_ids = itertools.count(1)
+
+    def on_reply(self, chat_id, reply_to: int, message_id: int, text: str, now: float):
+        """Ответ на reply_to покрывает и все более ранние обращённые сообщения чата без ответа"""
+        chat_id = int(chat_id)
+        pending = self.pending.get(chat_id)
+        if not pending:
+            return
+        covered = [sent for pending_id, sent in pending if pending_id <= reply_to]
+        if not covered:
+            return
+        self.pending[chat_id] = [item for item in pending if item[0] > reply_to]
+        self.first_reply.extend(now - sent for sent in covered)
+        self.replies[(chat_id, message_id)] = [covered, now]
+        if text.startswith("😔") or text == bot.CIRCUIT_OPEN_REPLY:
+            self.error_replies += 1
+
+    def on_edit(self, chat_id, message_id: int, now: float):
+        reply = self.replies.get((int(chat_id), message_id))
+        if reply is not None:
+            reply[1] = now
+
+    def make_chats(self) -> List[Dict[str, Any]]:
+        chats = []
+        for index in range(self.args.chats):
+            group = random.random() < self.args.group_ratio
+            chats.append({'id': -(10 ** 12 + index) if group else 10 ** 9 + index,
+                          'type': 'supergroup' if group else 'private'})
+        return chats
+
+    def build_update(self, chat: Dict[str, Any]):
+        """Обновление в формате Bot API и признак того, что бот должен на него ответить"""
+        update_id = next(self._update_ids)
+        user_id = random.randint(1, 50)
+        text = f"сообщение {update_id}: как дела?"
+        addressed = chat['type'] == 'private' or random.random() < self.args.mention_ratio
+        if chat['type'] != 'private' and addressed:
+            text = f"{random.choice(sorted(bot.DEFAULT_TRIGGERS))}, {text}"
+
+        data = bot.build_fake_update(text, chat['id'], update_id, user_id=user_id, username=f"user{user_id}",
+                                     chat_type=chat['type'])
+        if random.random() < self.args.image_ratio:
+            message = data['message']
+            del message['text']
+            message['photo'] = [{'file_id': f"photo{update_id}", 'file_unique_id': f"photo{update_id}",
+                                 'width': 640, 'height': 480, 'file_size': len(FAKE_IMAGE)}]
+            if chat['type'] != 'private' and addressed:
+                message['caption'] = text
+        return data, addressed
+
+    async def monitor_loop_lag(self, stop: asyncio.Event, interval: float = 0.05):
+        """Насколько позже запланированного просыпается корутина — задержка цикла событий"""
+        while not stop.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0.0, time.monotonic() - started - interval))
+
+    async def generate_traffic(self, application, chats: List[Dict[str, Any]]) -> int:
+        """Пуассоновский поток обновлений с общей интенсивностью rate в секунду"""
+        deadline = time.monotonic() + self.args.duration
+        count = 0
+        while time.monotonic() < deadline:
+            data, addressed = self.build_update(random.choice(chats))
+            if addressed:
+                message = data['message']
+                self.pending.setdefault(message['chat']['id'], []).append((message['message_id'], time.monotonic()))
+            await application.update_queue.put(bot.Update.de_json(data, application.bot))
+            count += 1
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        return count
+
+    async def wait_idle(self, application, server: FakeTelegramServer, tester: FakeGeminiTester):
+        """Ожидание, пока обработаются все очереди и дойдут отложенные ответы"""
+        processor = application.bot_data['update_processor']
+        quiet_for = self.args.debounce + 1.0
+        deadline = time.monotonic() + self.args.drain_timeout
+        while time.monotonic() < deadline:
+            stats = processor.get_stats()
+            busy = stats['queued'] or stats['active_chats'] or tester.pool_stats['in_flight'] \
+                or tester.pool_stats['queued'] or not application.update_queue.empty()
+            if not busy and time.monotonic() - server.last_activity >= quiet_for:
+                return True
+            await asyncio.sleep(0.1)
+        return False
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        server = FakeTelegramServer(on_reply=self.on_reply, on_edit=self.on_edit)
+        base_url = await server.start()
+
+        model = FakeGeminiModel(args.gemini_latency, args.gemini_jitter, args.chunks, args.chunk_interval,
+                                args.error_rate, args.quota_rate, args.reply_chars)
+        tester = FakeGeminiTester(model, rpm=args.rpm, tpm=args.tpm, max_concurrency=args.gemini_concurrency)
+        bot.gemini_tester = tester
+
+        application = bot.build_application(
+            base_url=f"{base_url}/bot",
+            base_file_url=f"{base_url}/file/bot",
+            updater=None
+        )
+        bot.register_handlers(application)
+        application.bot_data['debouncer'] = bot.ChatDebouncer(bot.reply_to_messages, window=args.debounce)
+
+        stop = asyncio.Event()
+        async with application:
+            await application.start()
+            lag_task = asyncio.create_task(self.monitor_loop_lag(stop))
+            started = time.monotonic()
+            sent = await self.generate_traffic(application, self.make_chats())
+            drained = await self.wait_idle(application, server, tester)
+            elapsed = time.monotonic() - started
+            stop.set()
+            await lag_task
+            await application.stop()
+            await bot.on_stop(application)
+        await bot.on_shutdown(application)
+        await server.close()
+
+        first = self.first_reply
+        complete = [last - sent for covered, last in self.replies.values() for sent in covered]
+        return {
+            'updates_sent': sent,
+            'replies': len(self.replies),
+            'answered_messages': len(first),
+            'unanswered_messages': sum(len(pending) for pending in self.pending.values()),
+            'error_replies': self.error_replies,
+            'drained': drained,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_updates_per_s': round(sent / elapsed, 2) if elapsed else 0.0,
+            'throughput_replies_per_s': round(len(self.replies) / elapsed, 2) if elapsed else 0.0,
+            'first_reply_s': {f"p{q}": percentile(first, q) for q in (50, 95, 99)},
+            'complete_reply_s': {f"p{q}": percentile(complete, q) for q in (50, 95, 99)},
+            'loop_lag_s': {
+                'p50': percentile(self.loop_lag, 50),
+                'p99': percentile(self.loop_lag, 99),
+                'max': max(self.loop_lag) if self.loop_lag else None,
+            },
+            'gemini': dict(model.stats),
+            'telegram_calls': dict(server.stats),
+            'update_processor': application.bot_data['update_processor'].get_stats(),
+        }
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    def ms(value):
+        return "—" if value is None else f"{value * 1000:.0f} мс"
+
+    lines = [
+        f"Обновлений отправлено: {result['updates_sent']} за {result['elapsed_s']:.1f} с"
+        f" ({result['throughput_updates_per_s']}/с)",
+        f"Ответов: {result['replies']} ({result['throughput_replies_per_s']}/с), с ошибкой: {result['error_replies']}",
+        f"Обращённых сообщений с ответом: {result['answered_messages']}, без ответа: {result['unanswered_messages']}",
+    ]
+    for title, key in (("Первый ответ", 'first_reply_s'), ("Ответ целиком", 'complete_reply_s')):
+        values = result[key]
+        lines.append(f"{title}: p50 {ms(values['p50'])}, p95 {ms(values['p95'])}, p99 {ms(values['p99'])}")
+    lag = result['loop_lag_s']
+    lines.append(f"Задержка цикла событий: p50 {ms(lag['p50'])}, p99 {ms(lag['p99'])}, макс. {ms(lag['max'])}")
+    lines.append(f"Gemini: {result['gemini']}")
+    lines.append(f"Telegram: {result['telegram_calls']}")
+    if not result['drained']:
+        lines.append("⚠️ Не все обновления обработаны до --drain-timeout")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельными Telegram и Gemini")
+    parser.add_argument('--chats', type=int, default=50, help="число чатов")
+    parser.add_argument('--rate', type=float, default=20.0, help="обновлений в секунду (все чаты)")
+    parser.add_argument('--duration', type=float, default=20.0, help="длительность подачи трафика, с")
+    parser.add_argument('--group-ratio', type=float, default=0.5, help="доля групповых чатов")
+    parser.add_argument('--mention-ratio', type=float, default=0.5,
+                        help="доля сообщений в группах, обращённых к боту")
+    parser.add_argument('--image-ratio', type=float, default=0.1, help="доля сообщений с картинкой")
+    parser.add_argument('--debounce', type=float, default=bot.DEBOUNCE_WINDOW,
+                        help="окно объединения сообщений, с")
+    parser.add_argument('--history-backend', choices=('json', 'sqlite'), default=bot.HISTORY_BACKEND)
+    parser.add_argument('--gemini-latency', type=float, default=0.5, help="задержка до первого чанка, с")
+    parser.add_argument('--gemini-jitter', type=float, default=0.3, help="разброс задержки (доля)")
+    parser.add_argument('--chunks', type=int, default=5, help="чанков в потоковом ответе")
+    parser.add_argument('--chunk-interval', type=float, default=0.1, help="интервал между чанками, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля запросов с ошибкой 503")
+    parser.add_argument('--quota-rate', type=float, default=0.0, help="доля запросов с ошибкой 429")
+    parser.add_argument('--reply-chars', type=int, default=400, help="длина ответа модели")
+    parser.add_argument('--gemini-concurrency', type=int, default=bot.GEMINI_MAX_CONCURRENCY,
+                        help="одновременных запросов к модели")
+    parser.add_argument('--rpm', type=int, default=1_000_000, help="квота ключа, запросов в минуту")
+    parser.add_argument('--tpm', type=int, default=1_000_000_000, help="квота ключа, токенов в минуту")
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help="сколько ждать обработки хвоста, с")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help="вывести результат в JSON")
+    parser.add_argument('--fail-p95', type=float, default=None,
+                        help="код выхода 1, если p95 первого ответа больше этого значения, с")
+    parser.add_argument('--keep-workdir', action='store_true', help="не удалять каталог с историей и настройками")
+    parser.add_argument('--verbose', action='store_true', help="не скрывать логи и вывод бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # История, настройки и трассы — во временном каталоге, рабочие файлы бота не трогаем
+    workdir = tempfile.mkdtemp(prefix="bot_loadtest_")
+    os.chdir(workdir)
+    bot.TELEGRAM_TOKEN = LOADTEST_TOKEN
+    bot.HISTORY_BACKEND = args.history_backend
+
+    stdout = sys.stdout
+    if not args.verbose:
+        # Промпты и ответы, которые бот печатает, и логи ошибок от внедрённых сбоев
+        logging.disable(logging.CRITICAL)
+        sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+    try:
+        result = asyncio.run(LoadTest(args).run())
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    print(json.dumps(result, ensure_ascii=False, indent=2) if args.json else format_report(result))
+    os.chdir(tempfile.gettempdir())
+    if args.keep_workdir:
+        print(f"Рабочий каталог: {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    p95 = result['first_reply_s']['p95']
+    if args.fail_p95 is not None and (p95 is None or p95 > args.fail_p95):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())